@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+#
+# Benchmark a no-op dry run of syncdirs and count the filesystem syscalls
+# it makes (stat, lstat, listdir, scandir and DirEntry.stat).
+#
+# With --index, the sync is run once to fill the index and then the second
+# run is measured, with --skip-unchanged-dirs.
+#
+# usage: bench_syncdirs.py [--index] [NDIRS] [NFILES]
+
+import sys, os, time, shutil, tempfile, getopt
+from collections import Counter
+
+import syncdirs
+
+counts = Counter()
+
+class CountingEntry(object):
+    def __init__(self, entry):
+        self.entry = entry
+        self.name = entry.name
+        self.path = entry.path
+        self.stat_result = None
+
+    def is_dir(self, follow_symlinks=True):
+        return self.entry.is_dir(follow_symlinks=follow_symlinks)
+
+    def is_file(self, follow_symlinks=True):
+        return self.entry.is_file(follow_symlinks=follow_symlinks)
+
+    def is_symlink(self):
+        return self.entry.is_symlink()
+
+    def stat(self, follow_symlinks=True):
+        if self.stat_result is None:
+            counts["stat"] += 1
+            self.stat_result = self.entry.stat(follow_symlinks=follow_symlinks)
+        return self.stat_result
+
+class CountingScandir(object):
+    def __init__(self, it):
+        self.it = it
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return CountingEntry(next(self.it))
+
+    def close(self):
+        self.it.close()
+
+def counting(name, func):
+    def wrapper(*args, **kwargs):
+        counts[name] += 1
+        return func(*args, **kwargs)
+    return wrapper
+
+def install_counters():
+    scandir = os.scandir
+    os.stat = counting("stat", os.stat)
+    os.lstat = counting("lstat", os.lstat)
+    os.listdir = counting("listdir", os.listdir)
+    os.scandir = counting("scandir", lambda path: CountingScandir(scandir(path)))
+
+def make_tree(root, ndirs, nfiles):
+    for i in range(ndirs):
+        dirpath = os.path.join(root, "dir{0:04d}".format(i))
+        os.makedirs(dirpath)
+        for j in range(nfiles):
+            with open(os.path.join(dirpath, "file{0:04d}".format(j)), "wb") as f:
+                f.write(b"x" * j)
+
+def main(args):
+    opts, args = getopt.gnu_getopt(args, "", ["index"])
+    use_index = ("--index", "") in opts
+    ndirs = int(args[0]) if len(args) > 0 else 100
+    nfiles = int(args[1]) if len(args) > 1 else 100
+    tmpdir = tempfile.mkdtemp(prefix="bench_syncdirs-")
+    try:
+        src = os.path.join(tmpdir, "src")
+        dst = os.path.join(tmpdir, "dst")
+        make_tree(src, ndirs, nfiles)
+        shutil.copytree(src, dst)
+        kwargs = {}
+        if use_index:
+            kwargs = dict(indexfile=os.path.join(tmpdir, "index"), skip_unchanged_dirs=True)
+            syncdirs.DirSyncer(src, dst, dryrun=True, **kwargs).run()
+        install_counters()
+        start = time.time()
+        syncdirs.DirSyncer(src, dst, dryrun=True, **kwargs).run()
+        elapsed = time.time() - start
+        result = dict(counts)
+    finally:
+        shutil.rmtree(tmpdir)
+    nentries = ndirs * (nfiles + 1)
+    total = sum(result.values())
+    for name in sorted(result):
+        print("{0:10} {1:10d}".format(name, result[name]))
+    print("{0:10} {1:10d} ({2:.2f} per entry per side)".format("total", total, total / 2.0 / nentries))
+    print("{0:10} {1:10.3f}s".format("time", elapsed))
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,59 @@
+#!/usr/bin/env python3
+#
+# Benchmark a no-change run of syncmusic and count the filesystem syscalls
+# it makes (stat, lstat, listdir, scandir, DirEntry.stat and mkdir).
+#
+# The destination is filled with stand-in outputs and synced once to write
+# the manifest, then the second run is measured. No encoder is run.
+#
+# usage: bench_syncmusic.py [NDIRS] [NFILES]
+
+import sys, os, time, shutil, tempfile, contextlib
+
+import bench_syncdirs
+from bench_syncdirs import counts, counting
+import syncmusic
+
+def make_library(src, dst, ndirs, nfiles):
+    for i in range(ndirs):
+        reldir = os.path.join("Artist {0:03d}".format(i // 10), "Album {0:04d}".format(i))
+        os.makedirs(os.path.join(src, reldir))
+        os.makedirs(os.path.join(dst, reldir))
+        for j in range(nfiles):
+            ext = "mp3" if j % 4 == 0 else "flac"
+            name = "{0:02d} Track.{1}".format(j, ext)
+            with open(os.path.join(src, reldir, name), "wb") as f:
+                f.write(b"x" * j)
+            with open(os.path.join(dst, reldir, syncmusic.replace_extension(name, ("flac",), "opus")), "wb") as f:
+                f.write(b"x" * j)
+
+def run(src, dst):
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        syncmusic.sync_music(src, dst, syncmusic.encoders["opus"])
+
+def main(args):
+    ndirs = int(args[0]) if len(args) > 0 else 100
+    nfiles = int(args[1]) if len(args) > 1 else 100
+    tmpdir = tempfile.mkdtemp(prefix="bench_syncmusic-")
+    try:
+        src = os.path.join(tmpdir, "src")
+        dst = os.path.join(tmpdir, "dst")
+        make_library(src, dst, ndirs, nfiles)
+        run(src, dst)
+        bench_syncdirs.install_counters()
+        os.mkdir = counting("mkdir", os.mkdir)
+        start = time.time()
+        run(src, dst)
+        elapsed = time.time() - start
+        result = dict(counts)
+    finally:
+        shutil.rmtree(tmpdir)
+    nfiles_total = ndirs * nfiles
+    total = sum(result.values())
+    for name in sorted(result):
+        print("{0:10} {1:10d}".format(name, result[name]))
+    print("{0:10} {1:10d} ({2:.2f} per file)".format("total", total, total / nfiles_total))
+    print("{0:10} {1:10.3f}s".format("time", elapsed))
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,274 @@
+#!/usr/bin/env python3
+#
+# Encoder worker pool shared by syncmusic and flac2opus.
+#
+# A job is an encoder command line writing to temporary output files. If
+# the job has a source file, it is decoded here and fed to the encoder on
+# stdin as a WAV stream: in-process with soundfile (libsndfile) if it is
+# installed, otherwise with a flac or ffmpeg process. The outputs are moved
+# into place when the encoder succeeds.
+#
+# The workers are threads that live for the whole run. The decoding is
+# done in C with the GIL released and the encoders are separate processes,
+# so threads are enough to keep every core busy.
+#
+# Each job reports how long it spent decoding, encoding and writing its
+# outputs.
+
+import os
+import struct
+import subprocess
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from dataclasses import dataclass, field
+from typing import List, Optional, Tuple
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+try:
+    import soundfile
+except ImportError:
+    soundfile = None
+
+# Frames per block read from the decoder
+decode_block_frames = 64 * 1024
+
+# Size of the pipes to and from the decoder and encoder, where it can be set
+pipe_size = 1024 * 1024
+F_SETPIPE_SZ = 1031
+
+def set_pipe_size(f):
+    if fcntl is not None:
+        try:
+            fcntl.fcntl(f.fileno(), getattr(fcntl, "F_SETPIPE_SZ", F_SETPIPE_SZ), pipe_size)
+        except OSError:
+            pass
+
+WAVE_FORMAT_PCM = 1
+WAVE_FORMAT_IEEE_FLOAT = 3
+
+# Sources with at most 16 bits are decoded to 16-bit PCM, anything deeper
+# to 32-bit float, which holds 24-bit samples exactly
+pcm16_subtypes = {"PCM_S8", "PCM_U8", "PCM_16", "ULAW", "ALAW", "IMA_ADPCM", "MS_ADPCM", "GSM610", "DWVW_12", "DWVW_16"}
+
+def wav_header(channels, samplerate, frames, bits=16, format=WAVE_FORMAT_PCM):
+    block_align = channels * bits // 8
+    data_size = min(frames * block_align, 0xffffffff - 36)
+    return struct.pack("<4sI4s4sIHHIIHH4sI",
+                       b"RIFF", 36 + data_size, b"WAVE",
+                       b"fmt ", 16, format, channels, samplerate, samplerate * block_align, block_align, bits,
+                       b"data", data_size)
+
+class SoundfileDecoder:
+    """Decodes in-process with soundfile to 16-bit PCM or 32-bit float WAV,
+    depending on the source bit depth. A decode error ends the stream and
+    is reported as a nonzero status from close, like a decoder process."""
+
+    name = "soundfile"
+
+    def __init__(self, srcfile):
+        self.file = soundfile.SoundFile(srcfile)
+        self.error = None
+        if self.file.subtype in pcm16_subtypes:
+            self.dtype = "int16"
+            self.header = wav_header(self.file.channels, self.file.samplerate, self.file.frames)
+        else:
+            self.dtype = "float32"
+            self.header = wav_header(self.file.channels, self.file.samplerate, self.file.frames,
+                                     32, WAVE_FORMAT_IEEE_FLOAT)
+
+    def read(self):
+        if self.header:
+            header, self.header = self.header, None
+            return header
+        if self.error is not None:
+            return b""
+        try:
+            return bytes(self.file.buffer_read(decode_block_frames, dtype=self.dtype))
+        except RuntimeError as e:
+            self.error = e
+            return b""
+
+    def close(self):
+        self.file.close()
+        return 1 if self.error is not None else 0
+
+class ProcessDecoder:
+    """Decodes to WAV with flac for FLAC files, or ffmpeg otherwise."""
+
+    def __init__(self, srcfile):
+        if os.path.splitext(srcfile)[1].lower() == ".flac":
+            self.name = "flac"
+            cmd = ["flac", "--decode", "--stdout", "--silent", srcfile]
+        else:
+            self.name = "ffmpeg"
+            cmd = ["ffmpeg", "-hide_banner", "-nostdin", "-v", "error", "-i", srcfile, "-map", "0:a:0", "-f", "wav", "-"]
+        self.process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        set_pipe_size(self.process.stdout)
+
+    def read(self):
+        return self.process.stdout.read(decode_block_frames * 4)
+
+    def close(self):
+        self.process.stdout.close()
+        return self.process.wait()
+
+def open_decoder(srcfile):
+    if soundfile is not None:
+        try:
+            return SoundfileDecoder(srcfile)
+        except RuntimeError:
+            pass
+    return ProcessDecoder(srcfile)
+
+@dataclass
+class EncodeJob:
+    command: List[str]
+    outputs: List[Tuple[str, str]] = field(default_factory=list)  # (tmpfile, dstfile)
+    srcfile: Optional[str] = None  # decode and pipe to the encoder's stdin
+
+@dataclass
+class EncodeResult:
+    job: EncodeJob
+    returncode: int
+    decoder: Optional[str] = None
+    decode_time: Optional[float] = None
+    encode_time: float = 0.0
+    write_time: float = 0.0
+
+    def timings(self):
+        parts = []
+        if self.decode_time is not None:
+            parts.append("decode {0:.2f}s ({1})".format(self.decode_time, self.decoder))
+        parts.append("encode {0:.2f}s".format(self.encode_time))
+        parts.append("write {0:.2f}s".format(self.write_time))
+        return ", ".join(parts)
+
+def remove(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+def pipe_decoder(decoder, process, result):
+    decode_time = encode_time = 0.0
+    try:
+        while True:
+            start = time.perf_counter()
+            block = decoder.read()
+            decoded = time.perf_counter()
+            decode_time += decoded - start
+            if not block:
+                break
+            process.stdin.write(block)
+            encode_time += time.perf_counter() - decoded
+    except BrokenPipeError:
+        pass
+    finally:
+        try:
+            process.stdin.close()
+        except BrokenPipeError:
+            pass
+    result.decode_time = decode_time
+    result.encode_time = encode_time
+
+def encode(job):
+    """Run a job in the calling thread and return its EncodeResult."""
+    result = EncodeResult(job, returncode=None)
+    decoder = None
+    process = None
+    try:
+        if job.srcfile is not None:
+            decoder = open_decoder(job.srcfile)
+            result.decoder = decoder.name
+            process = subprocess.Popen(job.command, stdin=subprocess.PIPE)
+            set_pipe_size(process.stdin)
+            pipe_decoder(decoder, process, result)
+        else:
+            process = subprocess.Popen(job.command, stdin=subprocess.DEVNULL)
+        start = time.perf_counter()
+        result.returncode = process.wait()
+        result.encode_time += time.perf_counter() - start
+        if decoder is not None:
+            decoder_returncode = decoder.close()
+            decoder = None
+            if result.returncode == 0 and decoder_returncode != 0:
+                result.returncode = decoder_returncode
+        start = time.perf_counter()
+        if result.returncode == 0:
+            for tmpfile, dstfile in job.outputs:
+                os.replace(tmpfile, dstfile)
+        else:
+            for tmpfile, dstfile in job.outputs:
+                remove(tmpfile)
+        result.write_time = time.perf_counter() - start
+        return result
+    except:
+        if process is not None and process.poll() is None:
+            process.kill()
+            process.wait()
+        for tmpfile, dstfile in job.outputs:
+            remove(tmpfile)
+        raise
+    finally:
+        if decoder is not None:
+            decoder.close()
+
+class EncodePool:
+    """Runs jobs on a fixed set of worker threads and keeps the total time
+    spent in each stage."""
+
+    def __init__(self, jobs=None):
+        self.executor = ThreadPoolExecutor(jobs or os.cpu_count())
+        self.lock = threading.Lock()
+        self.totals = Counter()
+
+    def run(self, job):
+        result = encode(job)
+        with self.lock:
+            self.totals["jobs"] += 1
+            if result.decode_time is not None:
+                self.totals["decoded"] += 1
+                self.totals["decode"] += result.decode_time
+            self.totals["encode"] += result.encode_time
+            self.totals["write"] += result.write_time
+        return result
+
+    def submit(self, job):
+        return self.executor.submit(self.run, job)
+
+    def map(self, jobs):
+        """Run jobs and yield their results as they complete."""
+        for future in as_completed([self.submit(job) for job in jobs]):
+            yield future.result()
+
+    def summary(self):
+        with self.lock:
+            parts = []
+            # Jobs without a decoder are decoded by the encoder
+            if self.totals["decoded"]:
+                parts.append("decode {0:.2f}s".format(self.totals["decode"]))
+            parts.append("encode {0:.2f}s".format(self.totals["encode"]))
+            parts.append("write {0:.2f}s".format(self.totals["write"]))
+            return "{0} jobs: {1}".format(self.totals["jobs"], ", ".join(parts))
+
+    def shutdown(self, wait=True, cancel_futures=False):
+        self.executor.shutdown(wait=wait, cancel_futures=cancel_futures)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.shutdown(cancel_futures=exc[0] is not None)
+
+__all__ = [
+    "EncodeJob",
+    "EncodeResult",
+    "EncodePool",
+    "encode",
+]
@@ -0,0 +1,216 @@
+# Read the EXIF DateTimeOriginal of JPEG files, for fix_file_names_exif.py
+# and fix_file_times_exif.py.
+#
+# Only the APP1 segment is read from each file (at most 64 KiB), and only the
+# DateTimeOriginal and SubSecTimeOriginal tags are looked up in it, instead of
+# having exifread parse every tag including maker notes and thumbnails. Files
+# are read on a thread pool, since most of the time goes on waiting for the
+# disk.
+#
+# The results can be kept in an SQLite cache in the library root, so files
+# that haven't changed since the last run aren't opened at all.
+
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+import os
+import sqlite3
+import struct
+
+default_workers = 8
+
+JPEG_EXTENSIONS = ('.jpg', '.jpeg')
+
+TAG_EXIF_IFD = 0x8769
+TAG_DATETIME_ORIGINAL = 0x9003
+TAG_SUBSEC_TIME_ORIGINAL = 0x9291
+TYPE_ASCII = 2
+
+cache_name = '.exifdatetime-cache.sqlite'
+
+def find_jpeg_files(rootdir):
+    for dirpath, dirnames, filenames in os.walk(rootdir):
+        for filename in filenames:
+            if os.path.splitext(filename)[1].lower() in JPEG_EXTENSIONS:
+                yield os.path.join(dirpath, filename)
+
+def read_app1_exif(f):
+    """Return the TIFF data of the EXIF APP1 segment of a JPEG file, or None.
+    Stops at the start of the image data."""
+    if f.read(2) != b'\xff\xd8':
+        return None
+    while True:
+        marker = f.read(2)
+        if len(marker) < 2 or marker[0] != 0xff:
+            return None
+        while marker[1] == 0xff:
+            marker = marker[1:] + f.read(1)
+            if len(marker) < 2:
+                return None
+        if marker[1] in (0xd9, 0xda):  # EOI, SOS
+            return None
+        if marker[1] == 0x01 or 0xd0 <= marker[1] <= 0xd7:
+            continue
+        header = f.read(2)
+        if len(header) < 2:
+            return None
+        length = struct.unpack('>H', header)[0] - 2
+        if marker[1] == 0xe1:
+            data = f.read(length)
+            if data.startswith(b'Exif\0\0'):
+                return data[6:]
+        else:
+            f.seek(length, os.SEEK_CUR)
+
+def read_ifd(tiff, endian, offset):
+    """Return a dict of tag to (type, count, value field offset) for an IFD."""
+    count = struct.unpack_from(endian + 'H', tiff, offset)[0]
+    entries = {}
+    for i in range(count):
+        entry = offset + 2 + i * 12
+        tag, type, n = struct.unpack_from(endian + 'HHI', tiff, entry)
+        entries[tag] = (type, n, entry + 8)
+    return entries
+
+def read_ascii(tiff, endian, entry):
+    type, n, field = entry
+    if type != TYPE_ASCII:
+        return None
+    offset = field if n <= 4 else struct.unpack_from(endian + 'I', tiff, field)[0]
+    return tiff[offset:offset + n].split(b'\0', 1)[0].decode('ascii', 'replace').strip()
+
+def read_tiff_datetime(tiff):
+    """Return the DateTimeOriginal and SubSecTimeOriginal strings from TIFF
+    data, or None for either if missing."""
+    if tiff[:2] == b'II':
+        endian = '<'
+    elif tiff[:2] == b'MM':
+        endian = '>'
+    else:
+        return None, None
+    ifd0 = read_ifd(tiff, endian, struct.unpack_from(endian + 'I', tiff, 4)[0])
+    if TAG_EXIF_IFD not in ifd0:
+        return None, None
+    type, n, field = ifd0[TAG_EXIF_IFD]
+    exif_ifd = read_ifd(tiff, endian, struct.unpack_from(endian + 'I', tiff, field)[0])
+    dt = subsec = None
+    if TAG_DATETIME_ORIGINAL in exif_ifd:
+        dt = read_ascii(tiff, endian, exif_ifd[TAG_DATETIME_ORIGINAL])
+    if TAG_SUBSEC_TIME_ORIGINAL in exif_ifd:
+        subsec = read_ascii(tiff, endian, exif_ifd[TAG_SUBSEC_TIME_ORIGINAL])
+    return dt, subsec
+
+def parse_exif_datetime(dt_str, subsec=None):
+    dt_str = str(dt_str)
+    # Fix weird use of 24 for hour 00
+    if dt_str[11:13] == '24':
+        dt_str = dt_str[:11] + '00' + dt_str[13:]
+    dt = datetime.strptime(dt_str, '%Y:%m:%d %H:%M:%S')
+    if subsec:
+        subsec = str(subsec)[:6]
+        usec = int(subsec) * 10 ** (6 - len(subsec))
+        dt = dt.replace(microsecond=usec)
+    return dt
+
+def read_exif_datetime(filename):
+    """Return the EXIF DateTimeOriginal of a JPEG file as a naive datetime,
+    or None if it can't be read."""
+    try:
+        with open(filename, 'rb') as f:
+            tiff = read_app1_exif(f)
+        if tiff is None:
+            return None
+        dt, subsec = read_tiff_datetime(tiff)
+        if dt is None:
+            return None
+        return parse_exif_datetime(dt, subsec)
+    except (OSError, ValueError, struct.error):
+        return None
+
+class ExifCache:
+    """EXIF datetimes keyed by (device, inode, size, mtime), including files
+    with no datetime. Only used from one thread."""
+
+    def __init__(self, path):
+        self.path = path
+        self.db = sqlite3.connect(path)
+        self.db.execute('CREATE TABLE IF NOT EXISTS exif (dev INTEGER, ino INTEGER, size INTEGER, mtime_ns INTEGER, '
+                        'datetime TEXT, PRIMARY KEY (dev, ino))')
+        self.db.commit()
+        self.hits = 0
+        self.misses = 0
+        self.unsaved = 0
+
+    def get(self, st):
+        """Return (found, datetime or None) for a file's stat result."""
+        row = self.db.execute('SELECT size, mtime_ns, datetime FROM exif WHERE dev = ? AND ino = ?',
+                              (st.st_dev, st.st_ino)).fetchone()
+        if row is None or row[0] != st.st_size or row[1] != st.st_mtime_ns:
+            self.misses += 1
+            return False, None
+        self.hits += 1
+        return True, datetime.fromisoformat(row[2]) if row[2] else None
+
+    def put(self, st, dt):
+        self.db.execute('INSERT OR REPLACE INTO exif VALUES (?, ?, ?, ?, ?)',
+                        (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns, dt.isoformat() if dt else None))
+        self.unsaved += 1
+        if self.unsaved >= 1000:
+            self.save()
+
+    def update(self, filename, dt):
+        """Record a file again after changing its modified time."""
+        self.put(os.stat(filename), dt)
+
+    def clear(self):
+        self.db.execute('DELETE FROM exif')
+        self.db.commit()
+
+    def save(self):
+        self.db.commit()
+        self.unsaved = 0
+
+    def stats(self):
+        return 'exif cache: {} hits, {} misses'.format(self.hits, self.misses)
+
+    def close(self):
+        self.save()
+        self.db.close()
+
+def open_cache(rootdir, clear=False):
+    cache = ExifCache(os.path.join(rootdir, cache_name))
+    if clear:
+        cache.clear()
+    return cache
+
+def read_exif_datetimes(filenames, workers=default_workers, cache=None):
+    """Yield (filename, datetime or None) for each filename, in order,
+    reading up to workers files at a time. Files found in the cache aren't
+    read, and the rest are added to it."""
+    with ThreadPoolExecutor(workers) as executor:
+        pending = deque()
+        def result():
+            filename, future, st, dt = pending.popleft()
+            if future is not None:
+                dt = future.result()
+                if st is not None:
+                    cache.put(st, dt)
+            return filename, dt
+        for filename in filenames:
+            st = None
+            found = False
+            if cache is not None:
+                try:
+                    st = os.stat(filename)
+                except OSError:
+                    pass
+                else:
+                    found, dt = cache.get(st)
+            if found:
+                pending.append((filename, None, st, dt))
+            else:
+                pending.append((filename, executor.submit(read_exif_datetime, filename), st, None))
+            while len(pending) >= workers * 4 or (pending and pending[0][1] is None):
+                yield result()
+        while pending:
+            yield result()
@@ -1,81 +1,292 @@
 # Recursively rename JPEG files using the EXIF datetime to the format: IMG_%Y%m%d_%H%M%S
 # and also sets the file timestamp on the filesystem to the same datetime.
 #
+# The renames for the whole tree are planned before anything is changed.
+# Photos taken in the same second get a millisecond suffix if their
+# sub-second times differ, otherwise a sequence number in order of datetime
+# and old name, so the same files always get the same names. Renames are
+# ordered so no file is overwritten, going through a temporary name to
+# break cycles.
+#
+# The plan is written to a journal in the root directory and each rename is
+# marked off as it's done, so an interrupted run can be resumed or rolled
+# back with --resume or --rollback.
+#
 # Luke McCarthy 2022-10-09
 
 TIME_ZONE = 'Europe/London'
 
-from datetime import datetime, timezone
-import exifread
+from collections import defaultdict
+from datetime import datetime, timedelta, timezone
+import argparse
+import json
 import os
 import pytz
 import sys
 
+from exifdatetime import JPEG_EXTENSIONS, read_exif_datetimes, open_cache, default_workers
+
 tzinfo = pytz.timezone(TIME_ZONE)
 
-def read_exif(filename):
-    with open(filename, 'rb') as f:
-        return exifread.process_file(f)
+name_format = 'IMG_%Y%m%d_%H%M%S'
+journal_name = '.fix_file_names_exif-journal'
+temp_prefix = '.fix_file_names_exif-'
 
-def parse_exif_datetime(dt_str, subsec=None):
-    dt = datetime.strptime(str(dt_str), '%Y:%m:%d %H:%M:%S')
-    if subsec:
-        subsec = str(subsec)[:6]
-        usec = int(subsec) * 10 ** (6 - len(subsec))
-        dt = dt.replace(microsecond=usec)
-    return dt
+epoch = datetime(1970, 1, 1, tzinfo=timezone.utc)
 
-def read_exif_datetime(filename):
-    tags = read_exif(filename)
-    try:
-        exif_dt = str(tags['EXIF DateTimeOriginal'])
-        # Fix weird use of 24 for hour 00
-        if exif_dt[11:13] == '24':
-            exif_dt = exif_dt[:11] + '00' + exif_dt[13:]
-        return parse_exif_datetime(exif_dt, tags.get('EXIF SubSecTimeOriginal'))
-    except (KeyError, ValueError) as e:
-        print('error parsing exif datetime:', e)
-
-def set_file_timestamp(filename, dt):
-    dt = tzinfo.localize(dt)
-    file_timestamp = os.stat(filename).st_mtime
-    exif_timestamp = dt.timestamp()
-    if exif_timestamp != file_timestamp:
-        print('setting modified time {} for {}'.format(dt.isoformat(), filename))
-        os.utime(filename, (exif_timestamp, exif_timestamp))
-
-def rename_jpg_from_exif(old_filepath):
-    dt = read_exif_datetime(old_filepath)
-    if dt is not None:
-        dirpath, old_filename = os.path.split(old_filepath)
-        new_filename = dt.strftime('IMG_%Y%m%d_%H%M%S') + '.jpg'
-        new_filepath = os.path.join(dirpath, new_filename)
-        if new_filename != old_filename:
-            if os.path.exists(new_filepath):
-                print('filename already exists, skipping:', new_filepath)
+def exif_time_ns(dt):
+    return (tzinfo.localize(dt) - epoch) // timedelta(microseconds=1) * 1000
+
+def scan_tree(rootdir):
+    """Yield (dirpath, names, jpegs) for each directory under rootdir, where
+    names is the set of all names in the directory and jpegs maps the JPEG
+    file names to their stat results. Directories that can't be read are
+    reported and skipped, as renames can't be planned without all the
+    names in them."""
+    stack = [rootdir]
+    while stack:
+        dirpath = stack.pop()
+        names = set()
+        jpegs = {}
+        subdirs = []
+        try:
+            with os.scandir(dirpath) as it:
+                for entry in it:
+                    names.add(entry.name)
+                    if entry.is_dir(follow_symlinks=False):
+                        subdirs.append(entry.path)
+                    elif os.path.splitext(entry.name)[1].lower() in JPEG_EXTENSIONS and entry.is_file(follow_symlinks=False):
+                        jpegs[entry.name] = entry.stat(follow_symlinks=False)
+        except OSError as e:
+            print('error reading directory, skipping:', e)
+            continue
+        yield dirpath, names, jpegs
+        stack.extend(sorted(subdirs, reverse=True))
+
+def plan_names(datetimes, keep):
+    """Return a dict of old name to new name for the files in a directory,
+    given a dict of name to datetime for the files to rename and the set of
+    names that are staying put."""
+    groups = defaultdict(list)
+    for name, dt in datetimes.items():
+        groups[dt.strftime(name_format)].append((dt, name))
+    taken = set(keep)
+    new_names = {}
+    for base in sorted(groups):
+        group = sorted(groups[base])
+        if len(group) == 1:
+            stems = [base]
+        else:
+            millis = [dt.microsecond // 1000 for dt, name in group]
+            if len(set(millis)) == len(millis):
+                stems = ['{}_{:03d}'.format(base, ms) for ms in millis]
             else:
-                print('rename:', old_filepath, '->', new_filepath)
-                os.rename(old_filepath, new_filepath)
-                set_file_timestamp(new_filepath, dt)
+                stems = ['{}_{}'.format(base, i + 1) for i in range(len(group))]
+        seq = len(group)
+        for (dt, name), stem in zip(group, stems):
+            new_name = stem + '.jpg'
+            while new_name in taken:
+                seq += 1
+                new_name = '{}_{}.jpg'.format(base, seq)
+            taken.add(new_name)
+            new_names[name] = new_name
+    return new_names
+
+def order_renames(renames, names):
+    """Return the renames as a list of (old, new) in an order where no new
+    name exists at the time, breaking cycles with temporary names."""
+    pending = {old: new for old, new in renames.items() if old != new}
+    ordered = []
+    ntemp = 0
+    while pending:
+        ready = sorted(old for old, new in pending.items() if new not in pending)
+        if ready:
+            for old in ready:
+                ordered.append((old, pending.pop(old)))
+        else:
+            old = min(pending)
+            while True:
+                temp = '{}{}.tmp'.format(temp_prefix, ntemp)
+                ntemp += 1
+                if temp not in names:
+                    break
+            ordered.append((old, temp))
+            pending[temp] = pending.pop(old)
+    return ordered
+
+def plan_tree(rootdir, workers=default_workers, cache=None):
+    """Read the EXIF datetimes of all JPEG files under rootdir and return the
+    list of steps to rename them and set their modified times."""
+    dirs = list(scan_tree(rootdir))
+    filenames = [os.path.join(dirpath, name) for dirpath, names, jpegs in dirs for name in sorted(jpegs)]
+    datetimes = defaultdict(dict)
+    for filename, dt in read_exif_datetimes(filenames, workers, cache):
+        dirpath, name = os.path.split(filename)
+        if dt is None:
+            print('no valid exif datetime, skipping:', filename)
         else:
-            set_file_timestamp(old_filepath, dt)
+            datetimes[dirpath][name] = dt
+    steps = []
+    for dirpath, names, jpegs in dirs:
+        dir_datetimes = datetimes.get(dirpath)
+        if not dir_datetimes:
+            continue
+        reldir = os.path.relpath(dirpath, rootdir)
+        new_names = plan_names(dir_datetimes, names - set(dir_datetimes))
+        for old, new in order_renames(new_names, names):
+            steps.append({'op': 'rename', 'dir': reldir, 'old': old, 'new': new})
+        for name, dt in sorted(dir_datetimes.items()):
+            old_ns = jpegs[name].st_mtime_ns
+            new_ns = exif_time_ns(dt)
+            if old_ns != new_ns:
+                steps.append({'op': 'utime', 'dir': reldir, 'name': new_names[name], 'old_name': name,
+                              'old_ns': old_ns, 'new_ns': new_ns, 'datetime': dt.isoformat()})
+    return steps
+
+def step_path(rootdir, step, name):
+    return os.path.normpath(os.path.join(rootdir, step['dir'], name))
+
+def describe_step(rootdir, step):
+    if step['op'] == 'rename':
+        return 'rename: {} -> {}'.format(step_path(rootdir, step, step['old']), step_path(rootdir, step, step['new']))
     else:
-        print('no valid exif datetime, skipping:', old_filepath)
+        dt = tzinfo.localize(datetime.fromisoformat(step['datetime']))
+        return 'setting modified time {} for {}'.format(dt.isoformat(), step_path(rootdir, step, step['name']))
+
+def write_journal(path, steps):
+    f = open(path, 'w')
+    f.write(json.dumps({'steps': steps}) + '\n')
+    f.flush()
+    os.fsync(f.fileno())
+    return f
 
-def fix_file_names_exif(rootdir):
-    for dirpath, dirnames, filenames in os.walk(rootdir):
-        for filename in filenames:
-            if os.path.splitext(filename)[1].lower() in ('.jpg', '.jpeg'):
-                rename_jpg_from_exif(os.path.join(dirpath, filename))
+def read_journal(path):
+    """Return the steps in a journal and the number that were done."""
+    with open(path) as f:
+        steps = json.loads(f.readline())['steps']
+        done = 0
+        for line in f:
+            if line.endswith('\n'):
+                done = int(line) + 1
+    return steps, done
+
+def utime_batch(rootdir, steps, cache=None):
+    """Set the modified times of a run of files in one directory, resolving
+    names relative to the open directory."""
+    dirpath = os.path.join(rootdir, steps[0]['dir'])
+    dir_fd = os.open(dirpath, os.O_RDONLY | getattr(os, 'O_DIRECTORY', 0)) if os.utime in os.supports_dir_fd else None
+    try:
+        for step in steps:
+            print(describe_step(rootdir, step))
+            ns = (step['new_ns'], step['new_ns'])
+            if dir_fd is not None:
+                os.utime(step['name'], ns=ns, dir_fd=dir_fd)
+            else:
+                os.utime(step_path(rootdir, step, step['name']), ns=ns)
+            if cache is not None:
+                cache.update(step_path(rootdir, step, step['name']), datetime.fromisoformat(step['datetime']))
+    finally:
+        if dir_fd is not None:
+            os.close(dir_fd)
+
+def apply_steps(rootdir, steps, journal, start=0, cache=None):
+    """Apply the steps from start on, marking each off in the journal. The
+    step at start may already have been done by an interrupted run."""
+    i = start
+    while i < len(steps):
+        step = steps[i]
+        if step['op'] == 'rename':
+            old = step_path(rootdir, step, step['old'])
+            new = step_path(rootdir, step, step['new'])
+            if not (i == start and not os.path.lexists(old) and os.path.lexists(new)):
+                print(describe_step(rootdir, step))
+                if os.path.lexists(new):
+                    raise FileExistsError('rename target exists: ' + new)
+                os.rename(old, new)
+            end = i + 1
+        else:
+            end = i + 1
+            while end < len(steps) and steps[end]['op'] == 'utime' and steps[end]['dir'] == step['dir']:
+                end += 1
+            utime_batch(rootdir, steps[i:end], cache)
+        journal.write('{}\n'.format(end - 1))
+        journal.flush()
+        i = end
+
+def rollback_steps(rootdir, steps, done):
+    """Undo the first done steps (and the next, if it was done), newest first."""
+    for step in reversed(steps[:done + 1]):
+        if step['op'] == 'rename':
+            old = step_path(rootdir, step, step['old'])
+            new = step_path(rootdir, step, step['new'])
+            if os.path.lexists(new) and not os.path.lexists(old):
+                print('rename: {} -> {}'.format(new, old))
+                os.rename(new, old)
+    for step in steps[:done + 1]:
+        if step['op'] == 'utime':
+            # The renames are undone, so the file is back under its old name
+            os.utime(step_path(rootdir, step, step['old_name']), ns=(step['old_ns'], step['old_ns']))
+
+def fix_file_names_exif(rootdir, workers=default_workers, use_cache=True, clear_cache=False, dry_run=False):
+    cache = open_cache(rootdir, clear_cache) if use_cache else None
+    try:
+        steps = plan_tree(rootdir, workers, cache)
+        if dry_run:
+            for step in steps:
+                print(describe_step(rootdir, step))
+            return
+        journal_path = os.path.join(rootdir, journal_name)
+        with write_journal(journal_path, steps) as journal:
+            apply_steps(rootdir, steps, journal, cache=cache)
+        os.remove(journal_path)
+    finally:
+        if cache is not None:
+            cache.close()
+            print(cache.stats())
+
+def resume(rootdir):
+    journal_path = os.path.join(rootdir, journal_name)
+    steps, done = read_journal(journal_path)
+    with open(journal_path, 'a') as journal:
+        apply_steps(rootdir, steps, journal, done)
+    os.remove(journal_path)
+
+def rollback(rootdir):
+    journal_path = os.path.join(rootdir, journal_name)
+    steps, done = read_journal(journal_path)
+    rollback_steps(rootdir, steps, done)
+    os.remove(journal_path)
 
 def main():
-    if len(sys.argv) == 1:
-        fix_file_names_exif('.')
-    elif len(sys.argv) == 2:
-        fix_file_names_exif(sys.argv[1])
-    else:
-        print('usage: fix_file_names_exif.py [dir]', file=sys.stderr)
+    parser = argparse.ArgumentParser(description='Rename JPEG files from their EXIF datetime.')
+    parser.add_argument('dir', nargs='?', default='.')
+    parser.add_argument('-j', '--workers', type=int, default=default_workers,
+                        help='number of files to read at a time (default: %(default)s)')
+    parser.add_argument('-n', '--dry-run', action='store_true',
+                        help='print the renames without doing them')
+    parser.add_argument('--resume', action='store_true',
+                        help='finish an interrupted run from its journal')
+    parser.add_argument('--rollback', action='store_true',
+                        help='undo an interrupted run from its journal')
+    parser.add_argument('--no-cache', action='store_true',
+                        help="don't use the exif cache in the library root")
+    parser.add_argument('--clear-cache', action='store_true',
+                        help='clear the exif cache before reading')
+    args = parser.parse_args()
+    journal_path = os.path.join(args.dir, journal_name)
+    if args.resume or args.rollback:
+        if not os.path.exists(journal_path):
+            print('no journal found:', journal_path, file=sys.stderr)
+            sys.exit(1)
+        if args.resume:
+            resume(args.dir)
+        else:
+            rollback(args.dir)
+    elif os.path.exists(journal_path) and not args.dry_run:
+        print('found journal from an interrupted run, use --resume or --rollback:', journal_path, file=sys.stderr)
         sys.exit(1)
+    else:
+        fix_file_names_exif(args.dir, args.workers, not args.no_cache, args.clear_cache, args.dry_run)
 
 if __name__ == '__main__':
     main()
@@ -1,37 +1,18 @@
 # Script to fix file modified datetimes of JPEG images using EXIF data.
-# Requires pytz and exifread (pip install pytz exifread).
+# Requires pytz (pip install pytz).
 #
 # Luke McCarthy 2017-01-09
 
 TIME_ZONE = 'Europe/London'
 
-import sys
-import exifread
+import argparse
 import os
 import pytz
 from datetime import datetime, timezone
 
-def read_exif(filename):
-    with open(filename, 'rb') as f:
-        return exifread.process_file(f)
+from exifdatetime import find_jpeg_files, read_exif_datetimes, open_cache, default_workers
 
-def parse_exif_datetime(dt, subsec=None):
-    dt = datetime.strptime(str(dt), '%Y:%m:%d %H:%M:%S')
-    if subsec:
-        subsec = str(subsec)[:6]
-        usec = int(subsec) * 10 ** (6 - len(subsec))
-        dt = dt.replace(microsecond=usec)
-    return dt
-
-def read_exif_datetime(filename):
-    tags = read_exif(filename)
-    try:
-        return parse_exif_datetime(tags['EXIF DateTimeOriginal'], tags.get('EXIF SubSecTimeOriginal'))
-    except (KeyError, ValueError):
-        pass
-
-def set_file_time_from_exif(filename, tzinfo=timezone.utc):
-    dt = read_exif_datetime(filename)
+def set_file_time_from_exif(filename, dt, tzinfo=timezone.utc, cache=None):
     if dt:
         dt = tzinfo.localize(dt)
         file_timestamp = os.stat(filename).st_mtime
@@ -39,13 +20,28 @@ def set_file_time_from_exif(filename, tzinfo=timezone.utc):
         if exif_timestamp != file_timestamp:
             print('setting modified time {} -> {} for {}'.format(datetime.fromtimestamp(file_timestamp).isoformat(), dt.isoformat(), filename))
             os.utime(filename, (exif_timestamp, exif_timestamp))
+            if cache is not None:
+                cache.update(filename, dt.replace(tzinfo=None))
 
-def fix_file_times_exif(rootdir, timezone=TIME_ZONE):
+def fix_file_times_exif(rootdir, timezone=TIME_ZONE, workers=default_workers, use_cache=True, clear_cache=False):
     tzinfo = pytz.timezone(timezone)
-    for dirpath, dirnames, filenames in os.walk(rootdir):
-        for filename in filenames:
-            if os.path.splitext(filename)[1].lower() in ('.jpg', '.jpeg'):
-                set_file_time_from_exif(os.path.join(dirpath, filename), tzinfo)
+    cache = open_cache(rootdir, clear_cache) if use_cache else None
+    try:
+        for filename, dt in read_exif_datetimes(find_jpeg_files(rootdir), workers, cache):
+            set_file_time_from_exif(filename, dt, tzinfo, cache)
+    finally:
+        if cache is not None:
+            cache.close()
+            print(cache.stats())
 
 if __name__ == '__main__':
-    fix_file_times_exif(sys.argv[1])
+    parser = argparse.ArgumentParser(description='Set the modified time of JPEG files from their EXIF datetime.')
+    parser.add_argument('dir')
+    parser.add_argument('-j', '--workers', type=int, default=default_workers,
+                        help='number of files to read at a time (default: %(default)s)')
+    parser.add_argument('--no-cache', action='store_true',
+                        help="don't use the exif cache in the library root")
+    parser.add_argument('--clear-cache', action='store_true',
+                        help='clear the exif cache before reading')
+    args = parser.parse_args()
+    fix_file_times_exif(args.dir, workers=args.workers, use_cache=not args.no_cache, clear_cache=args.clear_cache)
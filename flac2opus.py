@@ -3,37 +3,241 @@
 import sys
 import os
 import errno
+import getopt
 import shutil
+import struct
 import subprocess
+import tempfile
 import re
+from concurrent.futures import wait, FIRST_COMPLETED
+
+import encodepool
 
 def oggenc(input_file, output_file):
     return subprocess.call(["oggenc", "-o", output_file, input_file])
 
-def get_flac_tags(filename):
-    output = subprocess.check_output(["metaflac", "--export-tags-to=-", filename])
+FLAC_STREAMINFO = 0
+FLAC_VORBIS_COMMENT = 4
+FLAC_PICTURE = 6
+
+def read_flac_blocks(filename, block_types):
+    """Yield (type, data) for the metadata blocks of the given types, reading
+    only the metadata at the start of the file and seeking past other
+    blocks."""
+    with open(filename, "rb") as f:
+        if f.read(4) != b"fLaC":
+            raise ValueError("not a FLAC file: {0}".format(filename))
+        while True:
+            header = f.read(4)
+            if len(header) < 4:
+                break
+            block_type = header[0] & 0x7f
+            length = int.from_bytes(header[1:], "big")
+            if block_type in block_types:
+                data = f.read(length)
+                if len(data) < length:
+                    break
+                yield block_type, data
+            else:
+                f.seek(length, os.SEEK_CUR)
+            if header[0] & 0x80:
+                break
+
+def parse_vorbis_comment(data):
+    vendor_length, = struct.unpack_from("<I", data, 0)
+    pos = 4 + vendor_length
+    count, = struct.unpack_from("<I", data, pos)
+    pos += 4
     tags = []
-    for line in output.decode("utf-8").split("\n"):
-        tag = line.split("=", 1)
+    for i in range(count):
+        length, = struct.unpack_from("<I", data, pos)
+        pos += 4
+        tag = data[pos:pos + length].decode("utf-8", "replace").split("=", 1)
+        pos += length
         if len(tag) == 2:
             tags.append(tag)
     return tags
 
+def parse_picture(data):
+    """Return (picture type, MIME type, description, image data) from a FLAC
+    PICTURE block."""
+    picture_type, mime_length = struct.unpack_from(">II", data, 0)
+    pos = 8
+    mime = data[pos:pos + mime_length].decode("ascii", "replace")
+    pos += mime_length
+    desc_length, = struct.unpack_from(">I", data, pos)
+    pos += 4
+    desc = data[pos:pos + desc_length].decode("utf-8", "replace")
+    pos += desc_length + 16  # width, height, depth, colours
+    image_length, = struct.unpack_from(">I", data, pos)
+    pos += 4
+    return picture_type, mime, desc, data[pos:pos + image_length]
+
+def read_flac_metadata(filename):
+    """Return the tags and pictures of a FLAC file, without running metaflac."""
+    tags = []
+    pictures = []
+    for block_type, data in read_flac_blocks(filename, (FLAC_VORBIS_COMMENT, FLAC_PICTURE)):
+        if block_type == FLAC_VORBIS_COMMENT:
+            tags.extend(parse_vorbis_comment(data))
+        else:
+            pictures.append(parse_picture(data))
+    return tags, pictures
+
+def get_flac_tags(filename):
+    return read_flac_metadata(filename)[0]
+
 def flatten(xxs):
     return [x for xs in xxs for x in xs]
 
+def write_pictures(pictures):
+    """Write pictures to temporary files and return opusenc --picture
+    arguments for them and the list of files to remove afterwards."""
+    args = []
+    files = []
+    for picture_type, mime, desc, image in pictures:
+        fd, path = tempfile.mkstemp(prefix="flac2opus-")
+        files.append(path)
+        with os.fdopen(fd, "wb") as f:
+            f.write(image)
+        spec = "|".join([str(picture_type), mime, desc.replace("|", "/"), "", path])
+        args += ["--picture", spec]
+    return args, files
+
+def remove_files(paths):
+    for path in paths:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+def flac_job(input_file, output_file):
+    """Return an encodepool.EncodeJob encoding a FLAC file to Opus with its
+    tags and pictures, and the picture files to remove when it is done."""
+    tags, pictures = read_flac_metadata(input_file)
+    picture_args, picture_files = write_pictures(pictures)
+    comment_args = flatten(("--comment", "{0}={1}".format(tag, value)) for tag, value in tags)
+    tmpfile = os.path.join(os.path.dirname(output_file), ".flac2opus-" + os.path.basename(output_file))
+    job = encodepool.EncodeJob(["opusenc", "--quiet"] + comment_args + picture_args + ["-", tmpfile],
+                               [(tmpfile, output_file)], input_file)
+    return job, picture_files
+
+def encode_flac(input_file, output_file):
+    """Encode a FLAC file to Opus and return the encodepool.EncodeResult."""
+    job, picture_files = flac_job(input_file, output_file)
+    try:
+        return encodepool.encode(job)
+    finally:
+        remove_files(picture_files)
+
 def opusenc(input_file, output_file):
-    tags = flatten(("--comment", "{0}={1}".format(tag, value)) for tag, value in get_flac_tags(input_file))
-    p = subprocess.Popen(
-        ["flac", "--decode", "--stdout", input_file], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
-    return subprocess.call(["opusenc"] + tags + ["-", output_file], stdin=p.stdout)
+    return encode_flac(input_file, output_file).returncode
+
+def find_flac_files(paths):
+    for path in paths:
+        if os.path.isdir(path):
+            for dirpath, dirnames, filenames in os.walk(path):
+                dirnames.sort()
+                for filename in sorted(filenames):
+                    if filename.lower().endswith(".flac") and not filename.startswith("."):
+                        yield os.path.join(dirpath, filename)
+        else:
+            yield path
+
+def batch_files(paths, outdir=None):
+    """Yield (input_file, output_file) for each FLAC file given or found
+    under a directory given. Outputs go alongside their inputs, or with
+    outdir, in the same place relative to outdir as the input is relative
+    to the directory given."""
+    for path in paths:
+        if os.path.isdir(path):
+            for input_file in find_flac_files([path]):
+                relpath = os.path.splitext(os.path.relpath(input_file, path))[0] + ".opus"
+                yield input_file, os.path.join(outdir or path, relpath)
+        else:
+            output_file = os.path.splitext(path)[0] + ".opus"
+            if outdir:
+                output_file = os.path.join(outdir, os.path.basename(output_file))
+            yield path, output_file
+
+def up_to_date(input_file, output_file):
+    try:
+        return os.stat(output_file).st_mtime >= os.stat(input_file).st_mtime
+    except FileNotFoundError:
+        return False
+
+def flac2opus_batch(paths, outdir=None, jobs=None):
+    """Encode FLAC files as described for batch_files, skipping outputs
+    newer than their inputs. Up to jobs files are encoded at a time and at
+    most twice that are read ahead. Returns the number of failures."""
+    jobs = jobs or os.cpu_count()
+    counts = dict(encoded=0, skipped=0, failed=0)
+    pending = {}
+
+    def finish(done):
+        for future in done:
+            input_file, output_file, picture_files = pending.pop(future)
+            remove_files(picture_files)
+            try:
+                result = future.result()
+            except Exception as e:
+                sys.stderr.write("flac2opus: {0}: {1}\n".format(input_file, e))
+                counts["failed"] += 1
+                continue
+            if result.returncode != 0:
+                sys.stderr.write("flac2opus: {0}: encoder returned error code {1}\n".format(input_file, result.returncode))
+                counts["failed"] += 1
+            else:
+                print("{0} ({1})".format(output_file, result.timings()))
+                counts["encoded"] += 1
+
+    with encodepool.EncodePool(jobs) as pool:
+        for input_file, output_file in batch_files(paths, outdir):
+            if up_to_date(input_file, output_file):
+                counts["skipped"] += 1
+                continue
+            try:
+                os.makedirs(os.path.dirname(output_file) or ".", exist_ok=True)
+                job, picture_files = flac_job(input_file, output_file)
+            except (OSError, ValueError) as e:
+                sys.stderr.write("flac2opus: {0}: {1}\n".format(input_file, e))
+                counts["failed"] += 1
+                continue
+            pending[pool.submit(job)] = (input_file, output_file, picture_files)
+            if len(pending) >= jobs * 2:
+                finish(wait(pending, return_when=FIRST_COMPLETED).done)
+        finish(wait(pending).done)
+        print("{encoded} encoded, {skipped} up to date, {failed} failed".format(**counts))
+        if counts["encoded"]:
+            print(pool.summary())
+    return counts["failed"]
+
+usage = """\
+usage: flac2opus INPUT.flac OUTPUT.opus
+       flac2opus [-j JOBS] [-o OUTDIR] FILE.flac|DIR...
+
+  -j, --jobs=N      encode N files at a time (default: number of cores)
+  -o, --output=DIR  mirror the input tree into DIR instead of writing
+                    each .opus next to its .flac
+"""
 
 def flac2opus(args):
-    if len(args) != 2:
-        sys.stderr.write("usage: flac2opus INPUT.flac OUTPUT.opus\n")
+    try:
+        opts, args = getopt.gnu_getopt(args, "j:o:", ["jobs=", "output="])
+        opts = dict(opts)
+        jobs = int(opts.get("-j", opts.get("--jobs", 0)))
+    except (getopt.GetoptError, ValueError) as e:
+        sys.stderr.write("flac2opus: {0}\n".format(e))
+        sys.stderr.write(usage)
+        sys.exit(1)
+    outdir = opts.get("-o", opts.get("--output"))
+    if not args:
+        sys.stderr.write(usage)
         sys.exit(1)
+    elif len(args) == 2 and args[1].lower().endswith(".opus") and not opts:
+        sys.exit(1 if opusenc(args[0], args[1]) != 0 else 0)
     else:
-        opusenc(args[0], args[1])
+        sys.exit(1 if flac2opus_batch(args, outdir, jobs) else 0)
 
 if __name__ == "__main__":
     try:
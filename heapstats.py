@@ -0,0 +1,452 @@
+#!/usr/bin/env python3
+"""
+Heap statistics for finding memory leaks, without a UI. This is the engine
+behind memusage.MemoryUsageDialog, and can also be used on its own in
+headless processes:
+
+    import heapstats
+    heapstats.install_signal_handler('/tmp/heap-{pid}-{n}.json')
+
+makes SIGUSR1 write a JSON dump of per-type object counts and sizes, and of
+the top allocation sites if tracemalloc is tracing. To run a script this way,
+optionally starting tracemalloc and dumping at exit too:
+
+    heapstats.py [-o PATTERN] [-t NFRAMES] [-s] script.py [args...]
+
+and to print a dump:
+
+    heapstats.py -p dump.json
+
+A HeapSnapshot is one pass over gc.get_objects(), in chunks that release the
+GIL, gathering per-type counts and sizes into arrays indexed by type ids
+from a shared TypeTable, and up to max_instances instances of each type.
+SampleHistory keeps a ring buffer of snapshot counts for growth rates, and
+compute_retained_sizes estimates the size each type keeps alive by
+charging objects with a single referrer to it, and on up the chain.
+"""
+
+import sys
+import os
+import gc
+import json
+import time
+import types
+import getopt
+import runpy
+import signal
+import threading
+import tracemalloc
+from array import array
+from collections import deque
+
+def format_size(n):
+    if n < 1024:
+        return '%d B' % n
+    elif n < 1024**2:
+        return '%.2f KiB' % (float(n) / 1024)
+    elif n < 1024**3:
+        return '%.2f MiB' % (float(n) / 1024**2)
+    else:
+        return '%.2f GiB' % (float(n) / 1024**3)
+
+def format_class(cls):
+    return '%s.%s' % (cls.__module__, cls.__name__)
+
+
+counter_typecode = 'q'
+
+# Auto-sampling interval in seconds and the number of samples kept
+sample_interval = 10
+max_samples = 720
+
+class TypeTable:
+    """Interns types to small integer ids, shared by all snapshots so that
+    their arrays can be compared index by index."""
+
+    def __init__(self):
+        self.types = []
+        self.ids = {}
+
+    def intern(self, cls):
+        i = self.ids.get(cls)
+        if i is None:
+            i = self.ids[cls] = len(self.types)
+            self.types.append(cls)
+        return i
+
+class InstanceList(list):
+    """List of instances of a type kept by a HeapSnapshot, distinguished so
+    that it can be left out of the referrers view."""
+
+class HeapSnapshot:
+    """Per-type object counts and sizes. Types are interned in a TypeTable
+    to an id that indexes the counts and sizes arrays."""
+
+    def __init__(self, type_table=None, max_instances=1000):
+        self.type_table = type_table or TypeTable()
+        self.max_instances = max_instances
+        self.time = time.time()
+        self.counts = array(counter_typecode, [0]) * len(self.type_table.types)
+        self.sizes = array(counter_typecode, [0]) * len(self.type_table.types)
+        self.instances = {}
+
+    def add(self, objs):
+        type_ids = self.type_table.ids
+        counts = self.counts
+        sizes = self.sizes
+        instances = self.instances
+        getsizeof = sys.getsizeof
+        for obj in objs:
+            cls = type(obj)
+            i = type_ids.get(cls)
+            if i is None:
+                i = self.type_table.intern(cls)
+            if i >= len(counts):
+                counts.extend([0] * (i + 1 - len(counts)))
+                sizes.extend([0] * (i + 1 - len(sizes)))
+            counts[i] += 1
+            sizes[i] += getsizeof(obj)
+            if counts[i] <= self.max_instances:
+                cls_instances = instances.get(cls)
+                if cls_instances is None:
+                    cls_instances = instances[cls] = InstanceList()
+                cls_instances.append(obj)
+
+    def stats(self):
+        types = self.type_table.types
+        return [(types[i], self.sizes[i], count) for i, count in enumerate(self.counts) if count]
+
+    def total_size(self):
+        return sum(self.sizes)
+
+    def total_count(self):
+        return sum(self.counts)
+
+def take_snapshot(type_table=None, chunk_size=50000, max_instances=1000):
+    """Scan the heap into a HeapSnapshot, releasing the GIL between chunks."""
+    objs = gc.get_objects()
+    snapshot = HeapSnapshot(type_table, max_instances)
+    try:
+        for start in range(0, len(objs), chunk_size):
+            snapshot.add(objs[start:start + chunk_size])
+            time.sleep(0)
+    finally:
+        del objs
+    return snapshot
+
+class SnapshotThread(threading.Thread):
+    """Takes a snapshot in the background and passes it to callback, on the
+    snapshot thread."""
+
+    def __init__(self, callback, type_table=None):
+        super().__init__(name='heapstats-snapshot')
+        self.daemon = True
+        self.callback = callback
+        self.type_table = type_table
+
+    def run(self):
+        self.callback(take_snapshot(self.type_table))
+
+def compute_retained_sizes(objs, type_table, ignore=frozenset(), progress=None, chunk_size=20000):
+    """Return an array of the retained size of the instances of each type
+    in type_table, over the gc-tracked objects in objs. Objects whose ids
+    are in ignore, and their references, are left out. Types and modules
+    are never charged to the objects that refer to them. progress is called
+    with the fraction done after each chunk.
+
+    An object with a single referrer is charged, with everything charged
+    to it, to its nearest owner of a different type, and so on up the
+    chain. Skipping owners of the same type means a chain of objects of one
+    type (a linked list, a tree) is charged to the type once rather than at
+    every level."""
+    getsizeof = sys.getsizeof
+    get_referents = gc.get_referents
+    shared = -1
+    owner = {}
+    size = {}
+    otype = {}
+    total = 3 * len(objs) + 1
+
+    # Find each object's referrer, or that it has more than one
+    for n, obj in enumerate(objs):
+        oid = id(obj)
+        if oid in ignore:
+            continue
+        if oid not in size:
+            size[oid] = getsizeof(obj)
+            otype[oid] = type(obj)
+        for ref in get_referents(obj):
+            rid = id(ref)
+            if rid in ignore or isinstance(ref, (type, types.ModuleType)):
+                continue
+            parent = owner.get(rid)
+            if parent is None:
+                owner[rid] = oid
+                if rid not in size:
+                    size[rid] = getsizeof(ref)
+                    otype[rid] = type(ref)
+            elif parent != oid:
+                owner[rid] = shared
+        if n % chunk_size == 0:
+            if progress:
+                progress(float(n) / total)
+            time.sleep(0)
+
+    # Find each owned object's nearest owner of a different type. Objects
+    # passed on the way have the same type and the same such owner, so it
+    # is remembered for them and each object is only visited once.
+    target = {}
+    chain = []
+    for n, rid in enumerate(owner):
+        oid = rid
+        cls = otype[oid]
+        while True:
+            if oid in target:
+                dest = target[oid]
+                break
+            parent = owner.get(oid)
+            if parent is None or parent == shared:
+                dest = None
+                break
+            # Marked so that a cycle of owners ends here
+            target[oid] = None
+            chain.append(oid)
+            if otype[parent] is not cls:
+                dest = parent
+                break
+            oid = parent
+        for oid in chain:
+            target[oid] = dest
+        del chain[:]
+        if n % chunk_size == 0:
+            if progress:
+                progress(float(len(objs) + n * len(objs) // max(len(owner), 1)) / total)
+            time.sleep(0)
+
+    # Charge each object with what was charged to it to its target, once
+    # everything targeting it has been, so charges go on up the chain.
+    # Objects in a cycle of targets keep their charges.
+    waiting = {}
+    for dest in target.values():
+        if dest is not None:
+            waiting[dest] = waiting.get(dest, 0) + 1
+    charged = {}
+    ready = [oid for oid in target if oid not in waiting]
+    n = 0
+    while ready:
+        oid = ready.pop()
+        dest = target[oid]
+        if dest is None:
+            continue
+        charged[dest] = charged.get(dest, 0) + size[oid] + charged.get(oid, 0)
+        waiting[dest] -= 1
+        if waiting[dest] == 0 and dest in target:
+            ready.append(dest)
+        n += 1
+        if n % chunk_size == 0:
+            if progress:
+                progress(float(2 * len(objs) + n * len(objs) // max(len(target), 1)) / total)
+            time.sleep(0)
+
+    type_ids = type_table.ids
+    retained = array(counter_typecode, [0]) * len(type_table.types)
+    for obj in objs:
+        i = type_ids.get(type(obj))
+        if i is not None and i < len(retained):
+            oid = id(obj)
+            retained[i] += size.get(oid, 0) + charged.get(oid, 0)
+    return retained
+
+class RetainedSizeThread(threading.Thread):
+    """Computes retained sizes in the background, reporting progress and
+    the result to callbacks, on the retained size thread."""
+
+    def __init__(self, callback, progress, type_table, snapshot=None):
+        super().__init__(name='heapstats-retained')
+        self.daemon = True
+        self.callback = callback
+        self.progress = progress
+        self.type_table = type_table
+        self.snapshot = snapshot
+
+    def run(self):
+        objs = gc.get_objects()
+        ignore = set([id(objs)])
+        if self.snapshot is not None:
+            ignore.add(id(self.snapshot.instances))
+            ignore.update(id(instances) for instances in self.snapshot.instances.values())
+        self.snapshot = None
+        try:
+            retained = compute_retained_sizes(objs, self.type_table, ignore, self.progress)
+        finally:
+            del objs
+        self.callback(retained)
+
+def count_at(counts, i):
+    return counts[i] if i < len(counts) else 0
+
+class SampleHistory:
+    """Ring buffer of (time, counts) samples taken from snapshots, and a
+    baseline sample. Running sums over the buffer give each type's growth
+    rate by least squares without going over every sample."""
+
+    def __init__(self, maxlen=max_samples):
+        self.samples = deque()
+        self.maxlen = maxlen
+        self.baseline = None
+        self.origin = None
+        self.sum_t = 0.0
+        self.sum_tt = 0.0
+        self.sum_c = array('d')
+        self.sum_tc = array('d')
+
+    def update_sums(self, sample, sign):
+        t = sample[0] - self.origin
+        counts = sample[1]
+        self.sum_t += sign * t
+        self.sum_tt += sign * t * t
+        if len(counts) > len(self.sum_c):
+            self.sum_c.extend([0.0] * (len(counts) - len(self.sum_c)))
+            self.sum_tc.extend([0.0] * (len(counts) - len(self.sum_tc)))
+        sum_c = self.sum_c
+        sum_tc = self.sum_tc
+        for i, c in enumerate(counts):
+            if c:
+                sum_c[i] += sign * c
+                sum_tc[i] += sign * t * c
+
+    def add(self, snapshot):
+        sample = (snapshot.time, snapshot.counts)
+        if self.origin is None:
+            self.origin = snapshot.time
+        if self.baseline is None:
+            self.baseline = sample
+        self.samples.append(sample)
+        self.update_sums(sample, 1)
+        if len(self.samples) > self.maxlen:
+            self.update_sums(self.samples.popleft(), -1)
+
+    def set_baseline(self):
+        if self.samples:
+            self.baseline = self.samples[-1]
+
+    def previous(self):
+        return self.samples[-2] if len(self.samples) >= 2 else None
+
+    def growth_rate(self, i):
+        """Return the growth in count of type i per minute."""
+        n = len(self.samples)
+        denom = n * self.sum_tt - self.sum_t * self.sum_t
+        if n < 2 or denom <= 0 or i >= len(self.sum_c):
+            return 0.0
+        return 60.0 * (n * self.sum_tc[i] - self.sum_t * self.sum_c[i]) / denom
+
+
+def snapshot_json(snapshot, limit=None, tracemalloc_limit=100):
+    """Return a snapshot as a JSON-serialisable dict, with types by size,
+    and the top allocation sites by file and line if tracemalloc is
+    tracing."""
+    stats = sorted(snapshot.stats(), key=lambda x: x[1], reverse=True)
+    if limit:
+        stats = stats[:limit]
+    data = {
+        'time': snapshot.time,
+        'pid': os.getpid(),
+        'total_count': snapshot.total_count(),
+        'total_size': snapshot.total_size(),
+        'types': [{'type': format_class(cls), 'size': size, 'count': count} for cls, size, count in stats],
+    }
+    if tracemalloc.is_tracing():
+        data['allocation_sites'] = allocation_sites(tracemalloc_limit)
+    return data
+
+def allocation_sites(limit=100):
+    """Return the top allocation sites by size while tracemalloc is tracing."""
+    sites = []
+    for stat in tracemalloc.take_snapshot().statistics('lineno')[:limit]:
+        frame = stat.traceback[0]
+        sites.append({'file': frame.filename, 'line': frame.lineno, 'size': stat.size, 'count': stat.count})
+    return sites
+
+dump_count = 0
+
+def dump_json(path, limit=None):
+    """Take a snapshot and write it to path as JSON. Instances aren't kept.
+    path may contain {pid}, {time} and {n}, the number of the dump in this
+    process."""
+    global dump_count
+    dump_count += 1
+    snapshot = take_snapshot(max_instances=0)
+    path = path.format(pid=os.getpid(), time=int(snapshot.time), n=dump_count)
+    tmppath = path + '.tmp'
+    with open(tmppath, 'w') as f:
+        json.dump(snapshot_json(snapshot, limit), f, indent=1)
+    os.replace(tmppath, path)
+    return path
+
+default_dump_path = 'heapstats-{pid}-{n}.json'
+
+def install_signal_handler(path=default_dump_path, signum=None):
+    """Write a JSON dump to path whenever the process receives signum
+    (SIGUSR1 by default). Must be called from the main thread."""
+    if signum is None:
+        signum = signal.SIGUSR1
+
+    def handler(signum, frame):
+        try:
+            sys.stderr.write('heapstats: wrote %s\n' % dump_json(path))
+        except Exception as e:
+            sys.stderr.write('heapstats: dump failed: %s\n' % e)
+
+    signal.signal(signum, handler)
+
+def print_dump(path, limit=50, out=sys.stdout):
+    with open(path) as f:
+        data = json.load(f)
+    out.write('Total: %d objects (%s)\n\n' % (data['total_count'], format_size(data['total_size'])))
+    for entry in data['types'][:limit]:
+        out.write('%12s %10d  %s\n' % (format_size(entry['size']), entry['count'], entry['type']))
+    if 'allocation_sites' in data:
+        out.write('\n')
+        for site in data['allocation_sites'][:limit]:
+            out.write('%12s %10d  %s:%d\n' % (format_size(site['size']), site['count'], site['file'], site['line']))
+
+usage = """\
+usage: heapstats.py [-o PATTERN] [-t NFRAMES] [-s] script.py [args...]
+       heapstats.py -p DUMP.json
+
+  -o PATTERN  dump file name, may contain {pid}, {time} and {n}
+              (default: %s)
+  -t NFRAMES  trace allocations with tracemalloc, keeping NFRAMES frames
+  -s          only dump on SIGUSR1, not when the script exits
+  -p DUMP     print a dump
+""" % default_dump_path
+
+def main(args):
+    try:
+        opts, args = getopt.getopt(args, 'o:t:sp:')
+        opts = dict(opts)
+        nframes = int(opts.get('-t', 0))
+    except (getopt.GetoptError, ValueError) as e:
+        sys.stderr.write('heapstats: %s\n%s' % (e, usage))
+        sys.exit(2)
+    if '-p' in opts:
+        print_dump(opts['-p'])
+        return
+    if not args:
+        sys.stderr.write(usage)
+        sys.exit(2)
+    path = opts.get('-o', default_dump_path)
+    if nframes:
+        tracemalloc.start(nframes)
+    install_signal_handler(path)
+    sys.argv = args
+    sys.path[0] = os.path.dirname(os.path.abspath(args[0]))
+    try:
+        runpy.run_path(args[0], run_name='__main__')
+    finally:
+        if '-s' not in opts:
+            sys.stderr.write('heapstats: wrote %s\n' % dump_json(path))
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
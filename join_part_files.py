@@ -1,59 +1,193 @@
-#!/usr/bin/env python
+#!/usr/bin/env python3
 #
 # Script to join numbered part files.
+#
+# The first part is renamed to become the joined file and the rest are
+# appended to it with copy_file_range (or sendfile), so the data isn't
+# copied through userspace and the filesystem can clone or offload it where
+# it supports that. Progress is checkpointed after each part, so running
+# again after an interruption carries on from the last part joined.
+#
+# The directories under drop_dir are joined concurrently, a few at a time.
 
-import sys
+import argparse
+import json
 import os
 import re
-import shutil
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 drop_dir = '/volume1/Download/NZBGet/dst'
 
-def join_part_files(dir_path):
-    all_files = os.listdir(dir_path)
-    prefix = os.path.commonprefix(all_files).rstrip('.')
+default_jobs = 2
+
+copy_chunk_size = 1 << 30
+buffer_size = 8 * 1024 * 1024
+
+print_lock = threading.Lock()
+
+def log(*args):
+    with print_lock:
+        print(*args, flush=True)
+
+def copy_range(src_fd, dst_fd, size):
+    """Append size bytes from src_fd to dst_fd at its current position,
+    using the fastest method the kernel supports for this pair of files."""
+    if size == 0:
+        return 0
+    kernel_copies = []
+    if hasattr(os, 'copy_file_range'):
+        kernel_copies.append(lambda offset, count: os.copy_file_range(src_fd, dst_fd, count, offset))
+    if hasattr(os, 'sendfile'):
+        kernel_copies.append(lambda offset, count: os.sendfile(dst_fd, src_fd, offset, count))
+    for kernel_copy in kernel_copies:
+        offset = 0
+        try:
+            while offset < size:
+                n = kernel_copy(offset, min(copy_chunk_size, size - offset))
+                if n == 0:
+                    break
+                offset += n
+        except OSError:
+            if offset:
+                raise
+            continue
+        # Some filesystems report success but copy nothing
+        if offset:
+            return offset
+    offset = 0
+    os.lseek(src_fd, 0, os.SEEK_SET)
+    while offset < size:
+        data = os.read(src_fd, min(buffer_size, size - offset))
+        if not data:
+            break
+        view = memoryview(data)
+        pos = 0
+        while pos < len(data):
+            pos += os.write(dst_fd, view[pos:])
+        offset += len(data)
+    return offset
+
+def find_part_files(dir_path):
+    all_files = [x for x in os.listdir(dir_path) if not x.endswith(('.joining', '.joining.progress', '.joining.progress.tmp'))]
+    prefix = os.path.commonprefix(all_files)
+    if prefix not in all_files:
+        # Drop the shared digits of the part numbers, e.g. "name.00"
+        prefix = re.sub(r'\.[0-9]{0,2}$', '', prefix)
+    prefix = prefix.rstrip('.')
     pattern = re.compile('^' + re.escape(prefix) + r'(\.[0-9]{3})?$')
     part_files = sorted(x for x in all_files if pattern.match(x))
-    if len(part_files) < 2:
-        print 'No part files found in:', dir_path
-        return False
-    if prefix in part_files and prefix + '.000' in part_files:
-        print 'Error: Ambiguous part files in:', dir_path
-        return False
+    return prefix, part_files
+
+def find_progress(dir_path):
+    for filename in os.listdir(dir_path):
+        if filename.endswith('.joining.progress'):
+            return os.path.join(dir_path, filename)
+    return None
+
+def read_progress(progress_path):
+    with open(progress_path) as f:
+        return json.load(f)
+
+def write_progress(progress_path, progress):
+    tmp_path = progress_path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(progress, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, progress_path)
+
+def join_part_files(dir_path):
+    progress_path = find_progress(dir_path)
+    if progress_path is not None:
+        progress = read_progress(progress_path)
+        prefix = progress['prefix']
+        part_files = progress['parts']
+        log('Resuming after {0} of {1} parts in: {2}'.format(progress['done'], len(part_files), dir_path))
+    else:
+        prefix, part_files = find_part_files(dir_path)
+        if len(part_files) < 2:
+            log('No part files found in:', dir_path)
+            return False
+        if prefix in part_files and prefix + '.000' in part_files:
+            log('Error: Ambiguous part files in:', dir_path)
+            return False
+        progress = {'prefix': prefix, 'parts': part_files, 'done': 0, 'size': 0}
+        progress_path = os.path.join(dir_path, prefix + '.joining.progress')
+        write_progress(progress_path, progress)
     prefix_path = os.path.join(dir_path, prefix)
     joining_path = prefix_path + '.joining'
+
+    # Interrupted after the joined file was renamed into place
+    if progress['done'] == len(part_files) and not os.path.exists(joining_path) and os.path.exists(prefix_path):
+        os.remove(progress_path)
+        return True
+
+    # The first part becomes the joined file, unless that was already done
+    if progress['done'] == 0:
+        if not os.path.exists(joining_path):
+            log('Joining:', part_files[0])
+            os.rename(os.path.join(dir_path, part_files[0]), joining_path)
+        progress['done'] = 1
+        progress['size'] = os.path.getsize(joining_path)
+        write_progress(progress_path, progress)
+
+    out_fd = os.open(joining_path, os.O_WRONLY)
     try:
-        with open(joining_path, 'wb') as out:
-            for part_name in part_files:
-                print 'Joining:', part_name
-                with open(os.path.join(dir_path, part_name), 'rb') as part:
-                    shutil.copyfileobj(part, out)
-    except Exception:
-        try:
-            os.remove(joining_path)
-        except OSError:
-            pass
-        raise
-    for part_name in part_files:
+        # Drop anything written after the last checkpoint
+        os.ftruncate(out_fd, progress['size'])
+        os.lseek(out_fd, progress['size'], os.SEEK_SET)
+        for part_name in part_files[progress['done']:]:
+            log('Joining:', part_name)
+            part_fd = os.open(os.path.join(dir_path, part_name), os.O_RDONLY)
+            try:
+                size = os.fstat(part_fd).st_size
+                if copy_range(part_fd, out_fd, size) != size:
+                    raise OSError('Short copy from part file: ' + part_name)
+            finally:
+                os.close(part_fd)
+            os.fsync(out_fd)
+            progress['done'] += 1
+            progress['size'] += size
+            write_progress(progress_path, progress)
+    finally:
+        os.close(out_fd)
+
+    for part_name in part_files[1:]:
         try:
             os.remove(os.path.join(dir_path, part_name))
+        except FileNotFoundError:
+            pass
         except OSError as e:
-            print 'Error removing part file:', e
+            log('Error removing part file:', e)
     os.rename(joining_path, prefix_path)
+    os.remove(progress_path)
     return True
 
-def join_part_files_in_dirs(dir_path):
-    for filename in sorted(os.listdir(dir_path)):
-        path = os.path.join(dir_path, filename)
-        if os.path.isdir(path):
-            join_part_files(path)
+def join_part_files_concurrently(paths, jobs=default_jobs):
+    with ThreadPoolExecutor(jobs) as executor:
+        futures = [(path, executor.submit(join_part_files, path)) for path in paths]
+        for path, future in futures:
+            try:
+                future.result()
+            except OSError as e:
+                log('Error joining part files in {0}: {1}'.format(path, e))
+
+def join_part_files_in_dirs(dir_path, jobs=default_jobs):
+    paths = [os.path.join(dir_path, filename) for filename in sorted(os.listdir(dir_path))]
+    join_part_files_concurrently([path for path in paths if os.path.isdir(path)], jobs)
 
 def main():
-    if len(sys.argv) == 1:
-        join_part_files_in_dirs(drop_dir)
+    parser = argparse.ArgumentParser(description='Join numbered part files.')
+    parser.add_argument('dirs', nargs='*', metavar='DIR',
+                        help='directories to join the parts in (default: each directory under {0})'.format(drop_dir))
+    parser.add_argument('-j', '--jobs', type=int, default=default_jobs,
+                        help='number of directories to join at a time (default: %(default)s)')
+    args = parser.parse_args()
+    if not args.dirs:
+        join_part_files_in_dirs(drop_dir, args.jobs)
     else:
-        for path in sys.argv[1:]:
-            join_part_files(path)
+        join_part_files_concurrently(args.dirs, args.jobs)
 
 if __name__ == '__main__':
     main()
@@ -5,6 +5,26 @@ objects and the total size taken up by all objects of that type (note: since
 most Python objects store their data in a separate instance dict, this may be
 misleading).
 
+The 'Retained' button works out, in the background, the size each type keeps
+alive as well as its own: an object with a single referrer is charged to that
+referrer, and so on up the chain, which charges instance dicts and the
+contents of containers to their owners. Referrers of the object's own type are
+skipped, so a linked list is charged to its owner once. This is a cheap
+approximation of a dominator tree, and only counts objects that are owned
+outright.
+
+The heap is scanned on a background thread, in chunks so that the UI stays
+responsive, into a HeapSnapshot of per-type counts and sizes held in arrays.
+The same pass keeps up to 1000 instances of each type for the instance view,
+which holds them alive until the next refresh.
+
+To help find leaks, each refresh is also kept as a sample of per-type counts
+in a ring buffer. The list shows the change in count since the last refresh
+and since the baseline, which is the first sample until 'Baseline' is
+pressed, and the growth rate in objects per minute over all samples, which
+is a least-squares fit kept up to date as samples come and go. 'Auto' takes
+a sample every 10 seconds.
+
 The text box at the top can be used to search for a particular type. The list
 view is filtered on the text entered.
 
@@ -19,6 +39,13 @@ The 'Garbage' button displays a list of objects Python is unable to garbage
 collect. This is usually due to the cyclical references containing objects that
 implement the __del__() method.
 
+The 'Sites' button lists the top allocation sites by file and line, if
+tracemalloc is tracing (python -X tracemalloc, or tracemalloc.start()).
+
+The statistics themselves come from the heapstats module, which has no UI and
+can dump JSON snapshots from headless processes. This module needs wxPython 4
+(Phoenix) on Python 3.
+
 To include MemoryUsageDialog in your application, simply import the class and
 create it as you would any other wx.Dialog instance, e.g.
 
@@ -31,25 +58,13 @@ create it as you would any other wx.Dialog instance, e.g.
 Luke McCarthy, December 2014
 """
 
-import sys
 import gc
-import re
+import tracemalloc
 import wx
-from collections import defaultdict
 from contextlib import contextmanager
 
-def format_size(n):
-    if n < 1024:
-        return '%d B' % n
-    elif n < 1024**2:
-        return '%.2f KiB' % (float(n) / 1024)
-    elif n < 1024**3:
-        return '%.2f MiB' % (float(n) / 1024**2)
-    else:
-        return '%.2f GiB' % (float(n) / 1024**3)
-
-def format_class(cls):
-    return '%s.%s' % (cls.__module__, cls.__name__)
+from heapstats import (format_size, format_class, count_at, TypeTable, InstanceList, SampleHistory,
+                       SnapshotThread, RetainedSizeThread, allocation_sites, sample_interval)
 
 @contextmanager
 def frozen_window(window):
@@ -77,7 +92,7 @@ class HeapReferrersFrame(wx.Frame):
         root_item = self.tree.AddRoot(root_title)
         for root in roots:
             item = self.tree.AppendItem(root_item, repr(root))
-            self.tree.SetPyData(item, HeapNode(root))
+            self.tree.SetItemData(item, HeapNode(root))
             self.tree.SetItemHasChildren(item, True)
             self.tree.Bind(wx.EVT_TREE_ITEM_EXPANDING, self.OnTreeItemExpanding)
         self.tree.Expand(root_item)
@@ -85,45 +100,104 @@ class HeapReferrersFrame(wx.Frame):
 
     def OnTreeItemExpanding(self, evt):
         parent_item = evt.GetItem()
-        node = self.tree.GetPyData(parent_item)
+        node = self.tree.GetItemData(parent_item)
         if node and not node.expanded:
-            referrers = [referrer for referrer in gc.get_referrers(node.obj) if not isinstance(referrer, HeapNode)]
+            referrers = [referrer for referrer in gc.get_referrers(node.obj)
+                         if not isinstance(referrer, (HeapNode, InstanceList))]
             if referrers:
                 for referrer in referrers:
                     item = self.tree.AppendItem(parent_item, repr(referrer))
-                    self.tree.SetPyData(item, HeapNode(referrer))
+                    self.tree.SetItemData(item, HeapNode(referrer))
                     self.tree.SetItemHasChildren(item, True)
                 node.expanded = True
             else:
                 evt.Veto()
 
+class AllocationSitesFrame(wx.Frame):
+    def __init__(self, sites):
+        wx.Frame.__init__(self, None, size=(1000, 600), title='Allocation Sites')
+        self.listctrl = wx.ListCtrl(self, style=wx.LC_REPORT)
+        self.listctrl.InsertColumn(0, 'File', width=700)
+        self.listctrl.InsertColumn(1, 'Size', width=100)
+        self.listctrl.InsertColumn(2, 'Count', width=100)
+        for site in sites:
+            index = self.listctrl.InsertItem(self.listctrl.GetItemCount(), '%s:%d' % (site['file'], site['line']))
+            self.listctrl.SetItem(index, 1, format_size(site['size']))
+            self.listctrl.SetItem(index, 2, str(site['count']))
+        self.Show()
+
+class HeapListCtrl(wx.ListCtrl):
+    """Virtual list control showing rows of preformatted column strings."""
+
+    def __init__(self, parent):
+        wx.ListCtrl.__init__(self, parent, style=wx.LC_REPORT | wx.LC_VIRTUAL)
+        self.rows = []
+
+    def SetRows(self, rows):
+        self.rows = rows
+        self.SetItemCount(len(rows))
+        self.Refresh()
+
+    def OnGetItemText(self, item, col):
+        return self.rows[item][col]
+
 class MemoryUsageDialog(wx.Dialog):
     def __init__(self, parent):
         wx.Dialog.__init__(self, parent, title='Python Memory Usage', size=wx.Size(500, 600), style=wx.DEFAULT_DIALOG_STYLE|wx.RESIZE_BORDER)
 
         self.sort_col = 0
         self.sort_rev = False
+        self.snapshot = None
+        self.snapshot_thread = None
+        self.data = []
+        self.type_table = TypeTable()
+        self.history = SampleHistory()
+        self.retained = None
+        self.retained_thread = None
+        self.formatted = []
 
         self.filter = wx.TextCtrl(self)
         self.filter.SetFocus()
 
-        self.listctrl = wx.ListCtrl(self, style=wx.LC_REPORT)
+        self.listctrl = HeapListCtrl(self)
         self.listctrl.InsertColumn(0, 'Class', width=250)
         self.listctrl.InsertColumn(1, 'Size', width=100)
         self.listctrl.InsertColumn(2, 'Count', width=100)
+        self.listctrl.InsertColumn(3, 'Last', width=80)
+        self.listctrl.InsertColumn(4, 'Baseline', width=80)
+        self.listctrl.InsertColumn(5, 'Growth/min', width=90)
+        self.listctrl.InsertColumn(6, 'Retained', width=100)
 
         self.total_label = wx.StaticText(self, label='')
         btn_collect = wx.Button(self, label='&Collect')
         btn_garbage = wx.Button(self, label='&Garbage')
+        btn_sites = wx.Button(self, label='&Sites')
+        btn_sites.Enable(tracemalloc.is_tracing())
         btn_refresh = wx.Button(self, wx.ID_REFRESH)
+        btn_baseline = wx.Button(self, label='&Baseline')
+        self.auto_sample = wx.CheckBox(self, label='&Auto')
+        btn_retained = wx.Button(self, label='&Retained')
+        self.gauge = wx.Gauge(self, range=1000, size=wx.Size(80, -1))
+        self.gauge.Hide()
+        self.timer = wx.Timer(self)
 
         btnsizer = wx.BoxSizer(wx.HORIZONTAL)
         btnsizer.Add(self.total_label, 1, wx.ALIGN_CENTRE_VERTICAL)
         btnsizer.AddStretchSpacer()
+        btnsizer.Add(self.gauge, 0, wx.ALIGN_CENTRE_VERTICAL)
+        btnsizer.AddSpacer(5)
+        btnsizer.Add(btn_retained, 0, wx.ALIGN_CENTRE_VERTICAL)
+        btnsizer.AddSpacer(5)
+        btnsizer.Add(self.auto_sample, 0, wx.ALIGN_CENTRE_VERTICAL)
+        btnsizer.AddSpacer(5)
+        btnsizer.Add(btn_baseline, 0, wx.ALIGN_CENTRE_VERTICAL)
+        btnsizer.AddSpacer(5)
         btnsizer.Add(btn_collect, 0, wx.ALIGN_CENTRE_VERTICAL)
         btnsizer.AddSpacer(5)
         btnsizer.Add(btn_garbage, 0, wx.ALIGN_CENTRE_VERTICAL)
         btnsizer.AddSpacer(5)
+        btnsizer.Add(btn_sites, 0, wx.ALIGN_CENTRE_VERTICAL)
+        btnsizer.AddSpacer(5)
         btnsizer.Add(btn_refresh, 0, wx.ALIGN_CENTRE_VERTICAL)
 
         sizer = wx.BoxSizer(wx.VERTICAL)
@@ -134,7 +208,12 @@ class MemoryUsageDialog(wx.Dialog):
 
         self.Bind(wx.EVT_BUTTON, self.OnCollect, btn_collect)
         self.Bind(wx.EVT_BUTTON, self.OnGarbage, btn_garbage)
+        self.Bind(wx.EVT_BUTTON, self.OnSites, btn_sites)
         self.Bind(wx.EVT_BUTTON, self.OnRefresh, btn_refresh)
+        self.Bind(wx.EVT_BUTTON, self.OnBaseline, btn_baseline)
+        self.Bind(wx.EVT_BUTTON, self.OnRetained, btn_retained)
+        self.Bind(wx.EVT_CHECKBOX, self.OnAutoSample, self.auto_sample)
+        self.Bind(wx.EVT_TIMER, self.OnTimer, self.timer)
         self.Bind(wx.EVT_TEXT, self.OnFilterChanged, self.filter)
         self.Bind(wx.EVT_LIST_COL_CLICK, self.OnColumnClicked)
         self.Bind(wx.EVT_LIST_ITEM_ACTIVATED, self.OnItemDClick)
@@ -154,60 +233,130 @@ class MemoryUsageDialog(wx.Dialog):
             self.sort_col = col
             self.sort_rev = col > 0
         self.data.sort(key=self.sort_ordering, reverse=self.sort_rev)
+        self.FormatData()
+
+    def FormatData(self):
+        self.formatted = [(format_class(cls), format_size(size), str(count),
+                           '%+d' % delta_last, '%+d' % delta_baseline, '%+.1f' % rate,
+                           format_size(retained) if retained >= 0 else '')
+                          for (cls, size, count, delta_last, delta_baseline, rate, retained) in self.data]
 
     def RefreshData(self):
-        size_stats = defaultdict(int)
-        count_stats = defaultdict(int)
-        for obj in gc.get_objects():
-            size_stats[type(obj)] += sys.getsizeof(obj)
-            count_stats[type(obj)] += 1
-        self.data = [(cls, size, count_stats[cls]) for (cls, size) in size_stats.iteritems()]
+        snapshot = self.snapshot
+        previous = self.history.previous()
+        previous = previous[1] if previous else snapshot.counts
+        baseline = self.history.baseline[1]
+        self.data = []
+        for i, cls in enumerate(self.type_table.types):
+            count = count_at(snapshot.counts, i)
+            if count or count_at(previous, i) or count_at(baseline, i):
+                retained = count_at(self.retained, i) if self.retained is not None else -1
+                self.data.append((cls, count_at(snapshot.sizes, i), count,
+                                  count - count_at(previous, i), count - count_at(baseline, i),
+                                  self.history.growth_rate(i), retained))
         self.data.sort(key=self.sort_ordering, reverse=self.sort_rev)
+        self.FormatData()
 
     def RepopulateList(self):
-        pattern = re.compile(re.escape(self.filter.Value.strip()), re.I)
+        text = self.filter.Value.strip().lower()
         with frozen_window(self.listctrl):
-            self.listctrl.DeleteAllItems()
-            for id, (cls, size, count) in enumerate(self.data):
-                clsname = format_class(cls)
-                if pattern.search(clsname):
-                    index = self.listctrl.InsertStringItem(id, clsname)
-                    self.listctrl.SetStringItem(index, 1, format_size(size))
-                    self.listctrl.SetStringItem(index, 2, str(count))
+            clsname = self.GetSelectedClassName()
+            self.listctrl.SetRows([row for row in self.formatted if text in row[0].lower()])
+            self.SetSelectedClassName(clsname)
 
     def GetSelectedClassName(self):
         selected_index = self.listctrl.GetNextItem(-1, wx.LIST_NEXT_ALL, wx.LIST_STATE_SELECTED)
-        return self.listctrl.GetItemText(selected_index) if selected_index != wx.NOT_FOUND else ''
+        if selected_index != wx.NOT_FOUND and selected_index < len(self.listctrl.rows):
+            return self.listctrl.rows[selected_index][0]
+        return ''
 
     def SetSelectedClassName(self, clsname):
-        i = self.listctrl.FindItem(0, clsname)
-        if i != wx.NOT_FOUND:
-            self.listctrl.SetFocus()
-            self.listctrl.EnsureVisible(i)
-            self.listctrl.Select(i)
+        selected_index = self.listctrl.GetNextItem(-1, wx.LIST_NEXT_ALL, wx.LIST_STATE_SELECTED)
+        if selected_index != wx.NOT_FOUND:
+            self.listctrl.Select(selected_index, False)
+        for i, row in enumerate(self.listctrl.rows):
+            if row[0] == clsname:
+                self.listctrl.EnsureVisible(i)
+                self.listctrl.Select(i)
+                break
 
     def Refresh(self):
-        with frozen_window(self.listctrl):
-            clsname = self.GetSelectedClassName()
+        if self.snapshot_thread is None:
+            # Let go of the instances held by the last snapshot, or they
+            # would be counted again even if nothing else refers to them
+            self.snapshot = None
+            self.total_label.SetLabel('Scanning...')
+            self.snapshot_thread = SnapshotThread(lambda snapshot: wx.CallAfter(self.OnSnapshot, snapshot),
+                                                  self.type_table)
+            self.snapshot_thread.start()
+
+    def OnSnapshot(self, snapshot):
+        if not self:
+            return
+        self.snapshot_thread = None
+        self.snapshot = snapshot
+        self.history.add(snapshot)
+        self.RefreshData()
+        self.RepopulateList()
+
+        self.total_label.SetLabel('Total: %d (%s)' % (snapshot.total_count(), format_size(snapshot.total_size())))
+
+    def OnRefresh(self, evt):
+        self.Refresh()
+
+    def OnBaseline(self, evt):
+        self.history.set_baseline()
+        if self.snapshot:
             self.RefreshData()
             self.RepopulateList()
-            if clsname:
-                self.SetSelectedClassName(clsname)
 
-        total_size = sum(x[1] for x in self.data)
-        total_count = sum(x[2] for x in self.data)
-        self.total_label.SetLabel('Total: %d (%s)' % (total_count, format_size(total_size)))
+    def OnRetained(self, evt):
+        if self.retained_thread is None:
+            self.gauge.SetValue(0)
+            self.gauge.Show()
+            self.Layout()
+            self.retained_thread = RetainedSizeThread(lambda retained: wx.CallAfter(self.OnRetainedDone, retained),
+                                                      lambda fraction: wx.CallAfter(self.OnRetainedProgress, fraction),
+                                                      self.type_table, self.snapshot)
+            self.retained_thread.start()
+
+    def OnRetainedProgress(self, fraction):
+        if self:
+            self.gauge.SetValue(int(fraction * 1000))
+
+    def OnRetainedDone(self, retained):
+        if not self:
+            return
+        self.retained_thread = None
+        self.retained = retained
+        self.gauge.Hide()
+        self.Layout()
+        if self.snapshot:
+            self.RefreshData()
+            self.RepopulateList()
 
-    def OnRefresh(self, evt):
+    def OnAutoSample(self, evt):
+        if self.auto_sample.IsChecked():
+            self.timer.Start(sample_interval * 1000)
+        else:
+            self.timer.Stop()
+
+    def OnTimer(self, evt):
         self.Refresh()
 
     def OnCollect(self, evt):
+        # Let go of the instances held by the last snapshot before collecting
+        self.snapshot = None
         gc.collect()
         self.Refresh()
 
     def OnGarbage(self, evt):
         HeapReferrersFrame('Uncollectable Garbage', gc.garbage)
 
+    def OnSites(self, evt):
+        if tracemalloc.is_tracing():
+            AllocationSitesFrame(allocation_sites(1000))
+
     def OnFilterChanged(self, evt):
         self.RepopulateList()
 
@@ -216,19 +365,18 @@ class MemoryUsageDialog(wx.Dialog):
         self.RepopulateList()
 
     def find_class(self, clsname):
-        for (cls, size, count) in self.data:
+        for row in self.data:
+            cls = row[0]
             if format_class(cls) == clsname:
                 return cls
 
     def OnItemDClick(self, evt):
-        cls = self.find_class(evt.GetItem().GetText())
-        if cls:
-            objs = []
-            for obj in gc.get_objects():
-                if type(obj) is cls:
-                    objs.append(obj)
-                if len(objs) >= 1000:
-                    break
+        index = evt.GetIndex()
+        if index < 0 or index >= len(self.listctrl.rows):
+            return
+        cls = self.find_class(self.listctrl.rows[index][0])
+        if cls and self.snapshot:
+            objs = list(self.snapshot.instances.get(cls, ()))
             title = 'Instances of {0.__module__}.{0.__name__}'.format(cls)
             HeapReferrersFrame(title, objs)
 
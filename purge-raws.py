@@ -1,17 +1,131 @@
 #!/usr/bin/env python3
+#
+# Delete RAW files that have a JPEG alongside them, with their XMP sidecars.
+#
+# Each directory is listed once and its files indexed by basename, so the
+# matching is done in memory instead of checking for every possible RAW
+# name. Directories are scanned and purged on a thread pool, which helps a
+# lot over a NAS.
+#
+# usage: purge-raws.py [-n] [-j N] [--keep EXTS] [--raw EXTS] [--sidecar EXTS] [DIR...]
 
+import argparse
 import os
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
 
 PHOTOS_ROOT = '/data/photos'
 
+KEEP_EXTENSIONS = ['.jpg', '.jpeg']
 RAW_EXTENSIONS = ['.RW2']
+SIDECAR_EXTENSIONS = ['.xmp']
 
-for dirpath, dirnamess, filenames in os.walk(PHOTOS_ROOT):
-    for filename in filenames:
-        if filename.lower().endswith('.jpg'):
-            for ext in RAW_EXTENSIONS:
-                raw_filename = os.path.splitext(filename)[0] + ext
-                raw_path = os.path.join(dirpath, raw_filename)
-                if os.path.exists(raw_path):
-                    print('Deleting {0}'.format(raw_path))
-                    os.remove(raw_path)
+default_jobs = 8
+
+def parse_extensions(s):
+    return [ext if ext.startswith('.') else '.' + ext for ext in s.split(',') if ext]
+
+def format_size(size):
+    for unit in ('bytes', 'KiB', 'MiB', 'GiB'):
+        if size < 1024 or unit == 'GiB':
+            break
+        size /= 1024
+    return '{0:.1f} {1}'.format(size, unit) if unit != 'bytes' else '{0} bytes'.format(size)
+
+def index_directory(dirpath):
+    """List a directory once and return (subdirs, index), where index maps
+    each basename to a dict of lowercased extension to entry. Only the
+    extension is case-folded, so IMG.JPG doesn't match img.RW2."""
+    subdirs = []
+    index = defaultdict(dict)
+    with os.scandir(dirpath) as it:
+        for entry in it:
+            if entry.is_dir(follow_symlinks=False):
+                subdirs.append(entry.path)
+            elif entry.is_file(follow_symlinks=False):
+                base, ext = os.path.splitext(entry.name)
+                index[base][ext.lower()] = entry
+    return subdirs, index
+
+def find_purgeable(index, keep, raw, sidecar):
+    """Return the entries to delete: RAW files with a JPEG of the same name,
+    and the sidecars of those RAW files (IMG.xmp or IMG.RW2.xmp)."""
+    purge = []
+    for base, files in index.items():
+        if not any(ext in files for ext in keep):
+            continue
+        raws = [files[ext] for ext in raw if ext in files]
+        if not raws:
+            continue
+        purge.extend(raws)
+        for ext in sidecar:
+            if ext in files:
+                purge.append(files[ext])
+            for entry in raws:
+                raw_sidecar = index.get(entry.name, {}).get(ext)
+                if raw_sidecar is not None:
+                    purge.append(raw_sidecar)
+    return sorted(purge, key=lambda entry: entry.name)
+
+def purge_directory(dirpath, keep, raw, sidecar, dry_run):
+    """Purge one directory and return (subdirs, deleted, errors), where
+    deleted is a list of (path, size)."""
+    subdirs, index = index_directory(dirpath)
+    deleted = []
+    errors = []
+    for entry in find_purgeable(index, keep, raw, sidecar):
+        try:
+            size = entry.stat(follow_symlinks=False).st_size
+            if not dry_run:
+                os.remove(entry.path)
+            deleted.append((entry.path, size))
+        except OSError as e:
+            errors.append('Error deleting {0}: {1}'.format(entry.path, e))
+    return subdirs, deleted, errors
+
+def purge_raws(roots, keep=KEEP_EXTENSIONS, raw=RAW_EXTENSIONS, sidecar=SIDECAR_EXTENSIONS,
+               dry_run=False, jobs=default_jobs):
+    """Purge the trees under roots and return (files, bytes) deleted."""
+    keep = [ext.lower() for ext in keep]
+    raw = [ext.lower() for ext in raw if ext.lower() not in keep]
+    sidecar = [ext.lower() for ext in sidecar]
+    nfiles = nbytes = 0
+    with ThreadPoolExecutor(jobs) as executor:
+        pending = {executor.submit(purge_directory, root, keep, raw, sidecar, dry_run) for root in roots}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                try:
+                    subdirs, deleted, errors = future.result()
+                except OSError as e:
+                    print('Error reading directory: {0}'.format(e))
+                    continue
+                for subdir in subdirs:
+                    pending.add(executor.submit(purge_directory, subdir, keep, raw, sidecar, dry_run))
+                for path, size in deleted:
+                    print('{0} {1}'.format('Would delete' if dry_run else 'Deleting', path))
+                    nfiles += 1
+                    nbytes += size
+                for error in errors:
+                    print(error)
+    return nfiles, nbytes
+
+def main():
+    parser = argparse.ArgumentParser(description='Delete RAW files that have a JPEG alongside them.')
+    parser.add_argument('dirs', nargs='*', default=[PHOTOS_ROOT], metavar='DIR')
+    parser.add_argument('-n', '--dry-run', action='store_true',
+                        help='print what would be deleted without deleting it')
+    parser.add_argument('-j', '--jobs', type=int, default=default_jobs,
+                        help='number of directories to scan at a time (default: %(default)s)')
+    parser.add_argument('--keep', type=parse_extensions, default=KEEP_EXTENSIONS, metavar='EXTS',
+                        help='comma-separated extensions of the files to keep (default: %(default)s)')
+    parser.add_argument('--raw', type=parse_extensions, default=RAW_EXTENSIONS, metavar='EXTS',
+                        help='comma-separated extensions of the files to delete (default: %(default)s)')
+    parser.add_argument('--sidecar', type=parse_extensions, default=SIDECAR_EXTENSIONS, metavar='EXTS',
+                        help='comma-separated extensions of sidecars deleted with them (default: %(default)s)')
+    args = parser.parse_args()
+    nfiles, nbytes = purge_raws(args.dirs, args.keep, args.raw, args.sidecar, args.dry_run, args.jobs)
+    print('{0} {1} files, {2}'.format('Would delete' if args.dry_run else 'Deleted', nfiles, format_size(nbytes)))
+
+if __name__ == '__main__':
+    main()
@@ -1,20 +1,183 @@
-#!/usr/bin/python
+#!/usr/bin/env python3
 
-import sys, os, time, shutil, getopt, errno, traceback
+import sys, os, time, shutil, getopt, errno, traceback, threading, sqlite3, hashlib, json, socket, queue
+from collections import namedtuple, Counter
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+FICLONE = 0x40049409
+COPY_CHUNK_SIZE = 1024 * 1024 * 1024
+COPY_BUFFER_SIZE = 8 * 1024 * 1024
+DELTA_BLOCK_SIZE = 1024 * 1024
+HASH_BLOCK_SIZE = 1024 * 1024
+
+# Errors meaning a copy backend doesn't work between two filesystems
+COPY_UNSUPPORTED_ERRNOS = frozenset([
+    errno.EOPNOTSUPP, errno.ENOTTY, errno.EXDEV, errno.EINVAL, errno.ENOSYS, errno.ETXTBSY])
+
+def copy_reflink(fsrc, fdst, size):
+    fcntl.ioctl(fdst, FICLONE, fsrc)
+
+def copy_kernel(kernel_copy, fsrc, fdst, size):
+    copied = 0
+    while True:
+        n = kernel_copy(fsrc, fdst, COPY_CHUNK_SIZE)
+        if n == 0:
+            break
+        copied += n
+    if copied == 0 and size > 0:
+        # Some filesystems report success but copy nothing
+        raise OSError(errno.EOPNOTSUPP, "No data copied")
+
+def copy_file_range(fsrc, fdst, size):
+    copy_kernel(lambda fsrc, fdst, count: os.copy_file_range(fsrc, fdst, count), fsrc, fdst, size)
+
+def copy_sendfile(fsrc, fdst, size):
+    copy_kernel(lambda fsrc, fdst, count: os.sendfile(fdst, fsrc, None, count), fsrc, fdst, size)
+
+def copy_userspace(fsrc, fdst, size):
+    buf = bytearray(COPY_BUFFER_SIZE)
+    view = memoryview(buf)
+    while True:
+        n = os.readv(fsrc, [buf])
+        if n == 0:
+            break
+        pos = 0
+        while pos < n:
+            pos += os.write(fdst, view[pos:n])
+
+def get_copy_backends():
+    backends = []
+    if fcntl and sys.platform.startswith("linux"):
+        backends.append(("reflink", copy_reflink))
+    if hasattr(os, "copy_file_range"):
+        backends.append(("copy_file_range", copy_file_range))
+    if hasattr(os, "sendfile") and sys.platform.startswith("linux"):
+        backends.append(("sendfile", copy_sendfile))
+    backends.append(("userspace", copy_userspace))
+    return backends
+
+copy_backends = get_copy_backends()
+
+def copy_delta(fsrc, fdst):
+    """Make fdst a copy of fsrc by comparing them block by block and
+    rewriting only the blocks that differ. Returns the bytes written."""
+    offset = 0
+    written = 0
+    while True:
+        block = os.pread(fsrc, DELTA_BLOCK_SIZE, offset)
+        if not block:
+            break
+        if os.pread(fdst, len(block), offset) != block:
+            view = memoryview(block)
+            pos = 0
+            while pos < len(block):
+                pos += os.pwrite(fdst, view[pos:], offset + pos)
+            written += len(block)
+        offset += len(block)
+    os.ftruncate(fdst, offset)
+    return written
+
+def parse_size(s):
+    """Parse a size in bytes with an optional K, M or G suffix."""
+    s = s.strip().upper()
+    scale = 1
+    for i, suffix in enumerate("KMG"):
+        if s.endswith(suffix):
+            s = s[:-1]
+            scale = 1024 ** (i + 1)
+    return int(s) * scale
 
 class DirSyncFS(object):
-    def __init__(self, dryrun=True):
+    def __init__(self, dryrun=True, delta_threshold=None, record=False):
         self.dryrun = dryrun
+        self.delta_threshold = delta_threshold
+        self.recorded = [] if record else None
+        self.lock = threading.Lock()
+        self.copy_backend_start = {}
+        self.copy_stats = {}
+
+    def record(self, *args):
+        if self.recorded is not None:
+            with self.lock:
+                self.recorded.append(args)
 
     def copy(self, src, dst):
+        self.record("copy", src, dst)
         if not self.dryrun:
             try:
-                shutil.copy2(src, dst)
+                if not self.copy_changed_blocks(src, dst):
+                    self.copy_data(src, dst)
+                shutil.copystat(src, dst)
             except OSError as e:
                 if e.errno != errno.EOPNOTSUPP:
                     raise
 
+    def copy_data(self, src, dst):
+        """Copy the contents of src to dst with the fastest backend that
+        works between their filesystems.
+
+        Backends are tried in order: FICLONE reflink, copy_file_range,
+        sendfile, then read/write with a large buffer. The first backend
+        that works for each pair of devices is remembered."""
+        start = time.time()
+        with open(src, "rb", buffering=0) as fsrc, open(dst, "wb", buffering=0) as fdst:
+            srcstat = os.fstat(fsrc.fileno())
+            key = (srcstat.st_dev, os.fstat(fdst.fileno()).st_dev)
+            i = self.copy_backend_start.get(key, 0)
+            while True:
+                name, copy_func = copy_backends[i]
+                try:
+                    copy_func(fsrc.fileno(), fdst.fileno(), srcstat.st_size)
+                    break
+                except OSError as e:
+                    if e.errno not in COPY_UNSUPPORTED_ERRNOS or i + 1 == len(copy_backends):
+                        raise
+                i += 1
+                with self.lock:
+                    self.copy_backend_start[key] = max(i, self.copy_backend_start.get(key, 0))
+                os.ftruncate(fdst.fileno(), 0)
+                os.lseek(fsrc.fileno(), 0, os.SEEK_SET)
+                os.lseek(fdst.fileno(), 0, os.SEEK_SET)
+        self.add_copy_stats(name, srcstat.st_size, srcstat.st_size, start)
+
+    def copy_changed_blocks(self, src, dst):
+        """Update an existing dst file of at least delta_threshold bytes in
+        place, writing only the blocks that differ from src.
+
+        Both files are local, so blocks are compared directly rather than
+        by rolling and strong checksums. Returns False if dst doesn't exist
+        or src is too small, in which case nothing is done."""
+        if self.delta_threshold is None:
+            return False
+        start = time.time()
+        with open(src, "rb", buffering=0) as fsrc:
+            size = os.fstat(fsrc.fileno()).st_size
+            if size < self.delta_threshold:
+                return False
+            try:
+                fdst = open(dst, "r+b", buffering=0)
+            except FileNotFoundError:
+                return False
+            with fdst:
+                written = copy_delta(fsrc.fileno(), fdst.fileno())
+        self.add_copy_stats("delta", size, written, start)
+        return True
+
+    def add_copy_stats(self, name, size, written, start):
+        with self.lock:
+            stats = self.copy_stats.setdefault(name, [0, 0, 0, 0.0])
+            stats[0] += 1
+            stats[1] += size
+            stats[2] += written
+            stats[3] += time.time() - start
+
     def copystat(self, src, dst):
+        self.record("copystat", src, dst)
         if not self.dryrun:
             try:
                 shutil.copystat(src, dst)
@@ -23,6 +186,7 @@ class DirSyncFS(object):
                     raise
 
     def mkdir(self, path):
+        self.record("mkdir", path)
         if not self.dryrun:
             try:
                 os.makedirs(path)
@@ -31,32 +195,26 @@ class DirSyncFS(object):
                     raise
 
     def rmdir(self, path):
+        self.record("rmdir", path)
         if not self.dryrun:
             os.rmdir(path)
 
+    def rename(self, src, dst):
+        self.record("rename", src, dst)
+        if not self.dryrun:
+            os.rename(src, dst)
+
     def remove(self, path):
+        self.record("remove", path)
         if not self.dryrun:
             os.remove(path)
 
-    def walk(self, path):
+    def scandir(self, path):
         try:
-            names = os.listdir(path)
+            with os.scandir(path) as it:
+                return sorted(it, key=entry_name)
         except EnvironmentError:
-            return
-        names.sort()
-        dirnames = []
-        filenames = []
-        for name in names:
-            if os.path.isdir(os.path.join(path, name)):
-                dirnames.append(name)
-            else:
-                filenames.append(name)
-        yield path, dirnames, filenames
-        for name in dirnames:
-            for subpath, dirnames, filenames in os.walk(os.path.join(path, name), topdown=False):
-                dirnames.sort()
-                filenames.sort()
-                yield subpath, dirnames, filenames
+            return UNLISTED
 
 def stat_changed(src, dst):
     # Allow 2 second error for rubbish filesystems
@@ -66,21 +224,543 @@ def stat_changed(src, dst):
         or (time_diff > 3601.0)
         or src.st_size != dst.st_size)
 
-def relpath(path, root):
-    rpath = os.path.relpath(path, root)
-    return "" if rpath == "." else rpath
+def entry_name(entry):
+    return entry.name
+
+# Entry kinds. Symlinks to directories are never followed, so they are
+# treated like any other special file.
+FILE, DIR, OTHER = "file", "dir", "other"
+
+# The entries of a directory that could not be listed. Nothing is planned
+# inside such a directory, as its contents are unknown.
+UNLISTED = None
+
+def entry_kind(entry):
+    if entry is None:
+        return None
+    try:
+        if entry.is_dir(follow_symlinks=False):
+            return DIR
+        if entry.is_file():
+            return FILE
+    except OSError:
+        pass
+    return OTHER
+
+def merge_entries(srcentries, dstentries):
+    """Merge-join two name-sorted scandir listings.
+
+    Yields (name, srcentry, dstentry) with None for a missing side."""
+    i = j = 0
+    while i < len(srcentries) or j < len(dstentries):
+        if j == len(dstentries) or (i < len(srcentries) and srcentries[i].name < dstentries[j].name):
+            yield srcentries[i].name, srcentries[i], None
+            i += 1
+        elif i == len(srcentries) or dstentries[j].name < srcentries[i].name:
+            yield dstentries[j].name, None, dstentries[j]
+            j += 1
+        else:
+            yield srcentries[i].name, srcentries[i], dstentries[j]
+            i += 1
+            j += 1
+
+# A single step of the sync plan. stat is the source file or directory's
+# stat and dststat the existing destination file's stat, where known.
+# COPYSTAT is applied to directories once their contents are in place.
+# MOVE renames the destination file oldpath to path, and STASH moves oldpath
+# out of the way if it would be removed before the MOVE happens. SKIPDIR
+# records a directory left alone because it could not be listed. COPYSTAT
+# and STASH are not logged.
+Action = namedtuple("Action", "op path stat dststat oldpath")
+Action.__new__.__defaults__ = (None, None, None)
+
+CachedStat = namedtuple("CachedStat", "st_size st_mtime st_ino st_dev")
+
+class CachedEntry(object):
+    """Stands in for an os.DirEntry in a listing read from the index.
+
+    If no stat was cached, stat() stats the file on first use."""
+
+    __slots__ = ("name", "path", "kind", "stat_result")
+
+    def __init__(self, name, path, kind, stat_result=None):
+        self.name = name
+        self.path = path
+        self.kind = kind
+        self.stat_result = stat_result
+
+    def is_dir(self, follow_symlinks=True):
+        return self.kind == DIR
+
+    def is_file(self, follow_symlinks=True):
+        return self.kind == FILE
+
+    def stat(self, follow_symlinks=True):
+        if self.stat_result is None:
+            self.stat_result = os.stat(self.path)
+        return self.stat_result
+
+class SyncIndex(object):
+    """SQLite cache of the directory listings and file stats seen by
+    previous runs, for both the source and destination trees.
+
+    A cached listing is only used while the directory's mtime is the same
+    as when it was cached. The index is kept up to date with the changes
+    made to the destination, and is cleared if a run aborts."""
+
+    def __init__(self, path, srcroot, dstroot):
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS roots (side TEXT PRIMARY KEY, path TEXT);
+            CREATE TABLE IF NOT EXISTS dirs (side TEXT, dir BLOB, mtime REAL,
+                PRIMARY KEY (side, dir));
+            CREATE TABLE IF NOT EXISTS entries (side TEXT, dir BLOB, name BLOB, kind TEXT,
+                size INTEGER, mtime REAL, ino INTEGER, dev INTEGER,
+                PRIMARY KEY (side, dir, name));
+            CREATE TABLE IF NOT EXISTS hashes (path BLOB PRIMARY KEY, size INTEGER, mtime REAL,
+                digest TEXT);
+        """)
+        roots = {"src": os.path.abspath(srcroot), "dst": os.path.abspath(dstroot)}
+        if dict(self.db.execute("SELECT side, path FROM roots")) != roots:
+            self.clear()
+            self.db.executemany("INSERT INTO roots VALUES (?, ?)", roots.items())
+
+    def clear(self):
+        with self.lock:
+            self.db.execute("DELETE FROM roots")
+            self.db.execute("DELETE FROM dirs")
+            self.db.execute("DELETE FROM entries")
+            self.db.execute("DELETE FROM hashes")
+
+    def commit(self):
+        with self.lock:
+            self.db.commit()
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+    def listing(self, side, dir, mtime, dirpath, trust_stats=True):
+        with self.lock:
+            row = self.db.execute("SELECT mtime FROM dirs WHERE side = ? AND dir = ?",
+                                  (side, os.fsencode(dir))).fetchone()
+            if row is None or row[0] != mtime:
+                return None
+            entries = []
+            for name, kind, size, mtime, ino, dev in self.db.execute(
+                    "SELECT name, kind, size, mtime, ino, dev FROM entries WHERE side = ? AND dir = ?",
+                    (side, os.fsencode(dir))):
+                name = os.fsdecode(name)
+                stat = CachedStat(size, mtime, ino, dev) if trust_stats and kind == FILE else None
+                entries.append(CachedEntry(name, os.path.join(dirpath, name), kind, stat))
+            entries.sort(key=entry_name)
+            return entries
+
+    def store_listing(self, side, dir, mtime, entries):
+        with self.lock:
+            bdir = os.fsencode(dir)
+            rows = []
+            for entry in entries:
+                kind = entry_kind(entry)
+                size = mtime_ = ino = dev = None
+                if kind == FILE:
+                    try:
+                        st = entry.stat()
+                        size, mtime_, ino, dev = st.st_size, st.st_mtime, st.st_ino, st.st_dev
+                    except OSError:
+                        pass
+                rows.append((side, bdir, os.fsencode(entry.name), kind, size, mtime_, ino, dev))
+            self.db.execute("DELETE FROM entries WHERE side = ? AND dir = ?", (side, bdir))
+            self.db.executemany("INSERT INTO entries VALUES (?, ?, ?, ?, ?, ?, ?, ?)", rows)
+            self.db.execute("INSERT OR REPLACE INTO dirs VALUES (?, ?, ?)", (side, bdir, mtime))
+
+    def apply(self, action):
+        """Record the effect of an action on the destination tree."""
+        with self.lock:
+            dir, name = (os.fsencode(x) for x in os.path.split(action.path))
+            if action.op == "COPY":
+                st = action.stat
+                self.db.execute("INSERT OR REPLACE INTO entries VALUES ('dst', ?, ?, ?, ?, ?, NULL, NULL)",
+                                (dir, name, FILE, st.st_size, st.st_mtime))
+            elif action.op == "MKDIR":
+                if action.path:
+                    self.db.execute("INSERT OR REPLACE INTO entries VALUES ('dst', ?, ?, ?, NULL, NULL, NULL, NULL)",
+                                    (dir, name, DIR))
+            elif action.op == "MOVE":
+                st = action.stat
+                self.db.execute("INSERT OR REPLACE INTO entries VALUES ('dst', ?, ?, ?, ?, ?, NULL, NULL)",
+                                (dir, name, FILE, st.st_size, st.st_mtime))
+                olddir, oldname = (os.fsencode(x) for x in os.path.split(action.oldpath))
+                self.db.execute("DELETE FROM entries WHERE side = 'dst' AND dir = ? AND name = ?",
+                                (olddir, oldname))
+            elif action.op in ("REMOVE", "STASH"):
+                self.db.execute("DELETE FROM entries WHERE side = 'dst' AND dir = ? AND name = ?", (dir, name))
+            elif action.op == "RMDIR":
+                path = os.fsencode(action.path)
+                self.db.execute("DELETE FROM entries WHERE side = 'dst' AND dir = ? AND name = ?", (dir, name))
+                self.db.execute("DELETE FROM entries WHERE side = 'dst' AND dir = ?", (path,))
+                self.db.execute("DELETE FROM dirs WHERE side = 'dst' AND dir = ?", (path,))
+            elif action.op == "COPYSTAT" and action.stat is not None:
+                # The destination directory now has the source directory's mtime
+                self.db.execute("INSERT OR REPLACE INTO dirs VALUES ('dst', ?, ?)",
+                                (os.fsencode(action.path), action.stat.st_mtime))
+
+    def get_hash(self, path):
+        with self.lock:
+            return self.db.execute("SELECT size, mtime, digest FROM hashes WHERE path = ?",
+                                   (os.fsencode(path),)).fetchone()
+
+    def put_hash(self, path, size, mtime, digest):
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO hashes VALUES (?, ?, ?, ?)",
+                            (os.fsencode(path), size, mtime, digest))
+
+def hash_file(path, uncached=False):
+    """Return the BLAKE2b digest of a file's contents.
+
+    With uncached, the file is flushed and dropped from the page cache
+    first, so that what is on disk is read back."""
+    h = hashlib.blake2b()
+    buf = bytearray(HASH_BLOCK_SIZE)
+    with open(path, "rb", buffering=0) as f:
+        if uncached and hasattr(os, "posix_fadvise"):
+            os.fsync(f.fileno())
+            os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+        view = memoryview(buf)
+        while True:
+            n = f.readinto(buf)
+            if not n:
+                break
+            h.update(view[:n])
+    return h.hexdigest()
+
+class HashCache(object):
+    """File content hashes, reused while a file's size and mtime are
+    unchanged. Kept in the index if there is one, otherwise in memory for
+    the current run. Files are keyed by absolute path, so the same file has
+    the same key whatever the working directory."""
+
+    def __init__(self, index=None):
+        self.index = index
+        self.lock = threading.Lock()
+        self.hashes = {}
+
+    def get(self, path):
+        path = os.path.abspath(path)
+        if self.index:
+            return self.index.get_hash(path)
+        with self.lock:
+            return self.hashes.get(path)
+
+    def put(self, path, st, digest):
+        path = os.path.abspath(path)
+        if self.index:
+            self.index.put_hash(path, st.st_size, st.st_mtime, digest)
+        else:
+            with self.lock:
+                self.hashes[path] = (st.st_size, st.st_mtime, digest)
+
+    def file_hash(self, path, st=None, uncached=False):
+        if st is None:
+            st = os.stat(path)
+        if not uncached:
+            cached = self.get(path)
+            if cached and cached[:2] == (st.st_size, st.st_mtime):
+                return cached[2]
+        digest = hash_file(path, uncached)
+        self.put(path, st, digest)
+        return digest
+
+def dir_key(path):
+    return os.path.normpath(path)
+
+class CopyExecutor(object):
+    """Runs copies on a pool of worker threads.
+
+    At most `jobs` copies run at once, and at most `device_jobs` of them
+    read from any one source device. A directory's attributes are copied
+    once all copies into it have finished. The first error raised by a
+    worker stops any further copies and is re-raised in the calling thread
+    by the next call to copy, copystat or wait."""
+
+    def __init__(self, copy, copystat, jobs, device_jobs=None):
+        self.copy_func = copy
+        self.copystat_func = copystat
+        self.pool = ThreadPoolExecutor(jobs)
+        self.queue_slots = threading.BoundedSemaphore(jobs * 2)
+        self.device_jobs = device_jobs or jobs
+        self.device_slots = {}
+        self.lock = threading.Lock()
+        self.pending = Counter()
+        self.deferred = {}
+        self.error = None
+
+    def check(self):
+        if self.error is not None:
+            raise self.error
+
+    def fail(self, e):
+        with self.lock:
+            if self.error is None:
+                self.error = e
+
+    def device_slot(self, dev):
+        with self.lock:
+            slot = self.device_slots.get(dev)
+            if slot is None:
+                slot = self.device_slots[dev] = threading.BoundedSemaphore(self.device_jobs)
+            return slot
+
+    def copy(self, src, dst, stat=None):
+        self.check()
+        self.queue_slots.acquire()
+        with self.lock:
+            self.pending[dir_key(os.path.dirname(dst))] += 1
+        self.pool.submit(self.copy_worker, src, dst, stat)
+
+    def copy_worker(self, src, dst, stat):
+        try:
+            if self.error is None:
+                with self.device_slot(stat.st_dev if stat else None):
+                    self.copy_func(src, dst, stat)
+        except BaseException as e:
+            self.fail(e)
+        finally:
+            self.queue_slots.release()
+            self.copy_done(dir_key(os.path.dirname(dst)))
+
+    def copy_done(self, key):
+        with self.lock:
+            self.pending[key] -= 1
+            if self.pending[key]:
+                return
+            del self.pending[key]
+            deferred = self.deferred.pop(key, None)
+        if deferred and self.error is None:
+            try:
+                self.copystat_func(*deferred)
+            except BaseException as e:
+                self.fail(e)
+
+    def copystat(self, src, dst):
+        self.check()
+        key = dir_key(dst)
+        with self.lock:
+            if self.pending.get(key):
+                self.deferred[key] = (src, dst)
+                return
+        self.copystat_func(src, dst)
+
+    def wait(self):
+        self.pool.shutdown(wait=True)
+        self.check()
+
+    def abort(self, e):
+        self.fail(e)
+        self.pool.shutdown(wait=True)
+
+class PipelineStage(object):
+    """Runs a generator on a background thread and passes its items to
+    the consuming thread through a bounded queue.
+
+    Items are sent in chunks of up to `batch`, but a partial chunk is sent
+    straight away if the consumer is waiting. An exception raised by the
+    generator is re-raised in the consumer."""
+
+    def __init__(self, generator, name, maxsize=64, batch=256):
+        self.generator = generator
+        self.queue = queue.Queue(maxsize)
+        self.batch = batch
+        self.cancelled = threading.Event()
+        self.thread = threading.Thread(target=self.produce, name=name)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def put(self, message):
+        while not self.cancelled.is_set():
+            try:
+                self.queue.put(message, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce(self):
+        try:
+            chunk = []
+            for item in self.generator:
+                chunk.append(item)
+                if len(chunk) >= self.batch or self.queue.empty():
+                    if not self.put(("items", chunk)):
+                        return
+                    chunk = []
+            if chunk and not self.put(("items", chunk)):
+                return
+            self.put(("end", None))
+        except BaseException as e:
+            self.put(("error", e))
+
+    def __iter__(self):
+        while True:
+            kind, value = self.queue.get()
+            if kind == "items":
+                for item in value:
+                    yield item
+            elif kind == "end":
+                return
+            else:
+                raise value
+
+    def cancel(self):
+        self.cancelled.set()
+        self.thread.join()
+
+class LogWriter(object):
+    """Appends lines to the log file as they are written, flushing every
+    `batch` lines or `interval` seconds, whichever comes first."""
+
+    def __init__(self, path, batch=100, interval=1.0):
+        self.f = open(path, "a", buffering=65536)
+        self.batch = batch
+        self.interval = interval
+        self.unflushed = 0
+        self.last_flush = time.time()
+
+    def write(self, s):
+        self.f.write(s)
+        self.unflushed += 1
+        if self.unflushed >= self.batch or time.time() - self.last_flush >= self.interval:
+            self.flush()
+
+    def flush(self):
+        self.f.flush()
+        self.unflushed = 0
+        self.last_flush = time.time()
+
+    def close(self):
+        self.f.close()
+
+def open_stream(dest):
+    """Open a text stream for writing to fd:N, unix:PATH, tcp:HOST:PORT or a file."""
+    kind, _, addr = dest.partition(":")
+    if kind == "fd":
+        return os.fdopen(int(addr), "w", closefd=False)
+    if kind == "unix":
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(addr)
+        return sock.makefile("w")
+    if kind == "tcp":
+        host, _, port = addr.rpartition(":")
+        return socket.create_connection((host, int(port))).makefile("w")
+    return open(dest, "a")
+
+class ProgressReporter(object):
+    """Writes machine-readable progress as JSON lines every `interval`
+    seconds from a background thread, and once more when stopped.
+
+    Throughput is measured from the start of the run and the ETA is for
+    the bytes planned so far. Files are counted as planned when the planner
+    finds them, which runs ahead of the copies on its own thread."""
+
+    def __init__(self, dest, interval=1.0):
+        self.stream = open_stream(dest)
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.report_loop, name="progress")
+        self.thread.daemon = True
+        self.start_time = time.time()
+        self.files_scanned = 0
+        self.files_planned = 0
+        self.bytes_planned = 0
+        self.files_copied = 0
+        self.bytes_copied = 0
+
+    def start(self):
+        self.start_time = time.time()
+        self.thread.start()
+
+    def scanned(self, n):
+        with self.lock:
+            self.files_scanned += n
+
+    def planned(self, size):
+        with self.lock:
+            self.files_planned += 1
+            self.bytes_planned += size
+
+    def unplanned(self, size):
+        with self.lock:
+            self.files_planned -= 1
+            self.bytes_planned -= size
+
+    def copied(self, size):
+        with self.lock:
+            self.files_copied += 1
+            self.bytes_copied += size
+
+    def report(self, state="running"):
+        with self.lock:
+            elapsed = time.time() - self.start_time
+            throughput = self.bytes_copied / elapsed if elapsed > 0 else 0.0
+            remaining = self.bytes_planned - self.bytes_copied
+            record = {
+                "time": time.time(),
+                "state": state,
+                "elapsed": round(elapsed, 3),
+                "files_scanned": self.files_scanned,
+                "files_planned": self.files_planned,
+                "bytes_planned": self.bytes_planned,
+                "files_copied": self.files_copied,
+                "bytes_copied": self.bytes_copied,
+                "throughput": round(throughput, 1),
+                "eta": round(remaining / throughput, 1) if throughput > 0 else None,
+            }
+        try:
+            self.stream.write(json.dumps(record) + "\n")
+            self.stream.flush()
+        except (EnvironmentError, ValueError):
+            # Monitoring going away shouldn't stop the sync
+            pass
+
+    def report_loop(self):
+        while not self.stopped.wait(self.interval):
+            self.report()
+
+    def stop(self, state):
+        self.stopped.set()
+        if self.thread.is_alive():
+            self.thread.join()
+        self.report(state)
+        try:
+            self.stream.close()
+        except EnvironmentError:
+            pass
 
 class DirSyncer(object):
-    def __init__(self, srcroot, dstroot, dryrun=True, logfile=None):
+    def __init__(self, srcroot, dstroot, dryrun=True, record=False, logfile=None, jobs=1, device_jobs=None,
+                 indexfile=None, skip_unchanged_dirs=False, delta_threshold=None,
+                 detect_moves=False, verify=False, progress=None):
         self.srcroot = srcroot
         self.dstroot = dstroot
-        self.fs = DirSyncFS(dryrun=dryrun)
+        self.fs = DirSyncFS(dryrun=dryrun, delta_threshold=delta_threshold, record=record)
+        self.copier = CopyExecutor(self.copy_file, self.fs.copystat, jobs, device_jobs) if jobs > 1 else None
+        self.index = SyncIndex(indexfile, srcroot, dstroot) if indexfile else None
+        self.skip_unchanged_dirs = skip_unchanged_dirs
+        self.detect_moves = detect_moves
+        self.verify = verify
+        self.hashes = HashCache(self.index)
+        self.stashed = {}
+        self.skipped = 0
+        self.stages = []
         self.logfile = logfile
-        self.loglines = []
+        self.logwriter = None
+        self.progress = ProgressReporter(progress) if progress else None
 
     def log_write(self, s):
-        if self.logfile:
-            self.loglines.append(s)
+        if self.logwriter:
+            self.logwriter.write(s)
 
     def log(self, *args):
         s = " ".join(str(arg) for arg in args) + "\n"
@@ -91,80 +771,301 @@ class DirSyncer(object):
     def log_marker(self, s):
         self.log_write("==== [{0}] {1}\n".format(get_timestamp(), s))
 
-    def visit_cleanup(self, dstdir, filenames):
-        dir = relpath(dstdir, self.dstroot)
-        srcdir = os.path.join(self.srcroot, dir)
-        for filename in filenames:
-            srcfile = os.path.join(srcdir, filename)
-            dstfile = os.path.join(dstdir, filename)
-            if os.path.isfile(dstfile) and not os.path.isfile(srcfile):
-                self.log("REMOVE", os.path.join(dir, filename))
-                self.fs.remove(dstfile)
-        if not os.path.isdir(srcdir):
-            self.log("RMDIR", dir)
-            self.fs.rmdir(dstdir)
-
-    def visit_copy(self, srcdir, filenames):
-        dir = relpath(srcdir, self.srcroot)
-        dstdir = os.path.join(self.dstroot, dir) 
-        if os.path.exists(dstdir):
-            if not os.path.isdir(dstdir):
-                self.log("REMOVE", dir)
-                self.fs.remove(dstdir)
-                self.log("MKDIR", dir)
-                self.fs.mkdir(dstdir)
+    def start_stage(self, generator, name):
+        stage = PipelineStage(generator, name)
+        self.stages.append(stage)
+        return iter(stage)
+
+    def plan(self):
+        """Walk both trees together and yield the actions needed to make
+        the destination match the source.
+
+        Each directory is listed once per side with scandir and each file
+        is stat'ed at most once per side. The listings come from a scanner
+        running on its own thread, so the next directories are listed
+        while the current one is being planned."""
+        if not os.path.isdir(self.srcroot):
+            raise EnvironmentError(errno.ENOTDIR, "Source is not a directory", self.srcroot)
+        dstexists = os.path.isdir(self.dstroot)
+        listings = self.start_stage(self.scan_dir("", dstexists), "scanner")
+        if not dstexists:
+            if os.path.lexists(self.dstroot):
+                yield Action("REMOVE", "")
+            yield Action("MKDIR", "")
+        for action in self.plan_dir(listings, "", dstexists):
+            yield action
+
+    def listdir(self, side, dir):
+        """List a directory of the source or destination tree.
+
+        Returns the directory's stat (if known) and its sorted entries, or
+        UNLISTED if it could not be listed. With an index, a directory whose mtime is unchanged since the last
+        run is listed from the index instead of with scandir. Cached file
+        stats are always trusted for the destination, but for the source
+        only with skip_unchanged_dirs, as modifying a file in place does not
+        change its directory's mtime."""
+        path = os.path.join(self.srcroot if side == "src" else self.dstroot, dir)
+        if self.index is None:
+            entries = self.fs.scandir(path)
+            if self.progress and side == "src" and entries is not UNLISTED:
+                self.progress.scanned(len(entries))
+            return None, entries
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None, UNLISTED
+        trust_stats = side == "dst" or self.skip_unchanged_dirs
+        entries = self.index.listing(side, dir, st.st_mtime, path, trust_stats)
+        if entries is None:
+            entries = self.fs.scandir(path)
+            if entries is UNLISTED:
+                return st, UNLISTED
+            self.index.store_listing(side, dir, st.st_mtime, entries)
+        if self.progress and side == "src":
+            self.progress.scanned(len(entries))
+        return st, entries
+
+    def scan_dir(self, dir, dstexists=True):
+        """Yield (dir, srcstat, srcentries, dstentries) for each directory
+        in the order plan_dir visits them. Destination directories that
+        are to be removed have srcentries of None. Directories with either
+        side UNLISTED are not descended into."""
+        srcstat, srcentries = self.listdir("src", dir)
+        dstentries = self.listdir("dst", dir)[1] if dstexists else []
+        yield dir, srcstat, srcentries, dstentries
+        if srcentries is UNLISTED or dstentries is UNLISTED:
+            return
+        for name, srcentry, dstentry in merge_entries(srcentries, dstentries):
+            path = os.path.join(dir, name)
+            srckind = entry_kind(srcentry)
+            dstkind = entry_kind(dstentry)
+            if dstkind == DIR and srckind != DIR:
+                for listing in self.scan_remove_dir(path):
+                    yield listing
+            if srckind == DIR:
+                for listing in self.scan_dir(path, dstexists=dstkind == DIR):
+                    yield listing
+
+    def scan_remove_dir(self, dir):
+        entries = self.listdir("dst", dir)[1]
+        yield dir, None, None, entries
+        if entries is UNLISTED:
+            return
+        for entry in entries:
+            if entry_kind(entry) == DIR:
+                for listing in self.scan_remove_dir(os.path.join(dir, entry.name)):
+                    yield listing
+
+    def plan_dir(self, listings, dir, dstexists=True):
+        listed, srcstat, srcentries, dstentries = next(listings)
+        assert listed == dir
+        if srcentries is UNLISTED or dstentries is UNLISTED:
+            # Without both listings we can't tell what to copy or remove
+            yield Action("SKIPDIR", dir)
+            return
+        for name, srcentry, dstentry in merge_entries(srcentries, dstentries):
+            path = os.path.join(dir, name)
+            srckind = entry_kind(srcentry)
+            dstkind = entry_kind(dstentry)
+            if dstkind == DIR and srckind != DIR:
+                for action in self.plan_remove_dir(listings, path):
+                    yield action
+                dstkind = None
+            elif (dstkind == FILE and srckind != FILE) or (dstkind == OTHER and srckind in (FILE, DIR)):
+                yield Action("REMOVE", path, dststat=self.removed_stat(dstentry))
+                dstkind = None
+            if srckind == DIR:
+                if dstkind != DIR:
+                    yield Action("MKDIR", path)
+                for action in self.plan_dir(listings, path, dstexists=dstkind == DIR):
+                    yield action
+            elif srckind == FILE:
+                filestat = srcentry.stat()
+                if dstkind != FILE:
+                    action = Action("COPY", path, filestat)
+                elif stat_changed(filestat, dstentry.stat()):
+                    action = Action("COPY", path, filestat, dstentry.stat())
+                else:
+                    continue
+                if self.progress:
+                    self.progress.planned(filestat.st_size)
+                yield action
+        yield Action("COPYSTAT", dir, srcstat)
+
+    def plan_remove_dir(self, listings, dir):
+        listed, _, _, entries = next(listings)
+        assert listed == dir
+        if entries is UNLISTED:
+            yield Action("SKIPDIR", dir)
+            return
+        for entry in entries:
+            path = os.path.join(dir, entry.name)
+            if entry_kind(entry) == DIR:
+                for action in self.plan_remove_dir(listings, path):
+                    yield action
+            else:
+                yield Action("REMOVE", path, dststat=self.removed_stat(entry))
+        yield Action("RMDIR", dir)
+
+    def removed_stat(self, entry):
+        # Only needed to match up moved files
+        if self.detect_moves and entry_kind(entry) == FILE:
+            try:
+                return entry.stat()
+            except OSError:
+                pass
+        return None
+
+    def plan_moves(self, actions):
+        """Turn a REMOVE and a COPY of the same file into a MOVE.
+
+        Candidates are matched by size and mtime and then confirmed by
+        comparing content hashes. Needs the whole plan in memory."""
+        removed = {}
+        for i, action in enumerate(actions):
+            if action.op == "REMOVE" and action.dststat is not None:
+                removed.setdefault(action.dststat.st_size, []).append(i)
+        for i, action in enumerate(actions):
+            if action is None or action.op != "COPY" or action.dststat is not None:
+                continue
+            candidates = removed.get(action.stat.st_size, [])
+            for j in candidates:
+                remove = actions[j]
+                if stat_changed(action.stat, remove.dststat):
+                    continue
+                srcpath = os.path.join(self.srcroot, action.path)
+                dstpath = os.path.join(self.dstroot, remove.path)
+                try:
+                    same = (self.hashes.file_hash(srcpath, action.stat) ==
+                            self.hashes.file_hash(dstpath, remove.dststat))
+                except EnvironmentError:
+                    same = False
+                if same:
+                    candidates.remove(j)
+                    actions[i] = Action("MOVE", action.path, action.stat, oldpath=remove.path)
+                    if self.progress:
+                        self.progress.unplanned(action.stat.st_size)
+                    actions[j] = Action("STASH", remove.path) if j < i else None
+                    break
+        return [action for action in actions if action is not None]
+
+    def execute(self, action):
+        srcpath = os.path.join(self.srcroot, action.path)
+        dstpath = os.path.join(self.dstroot, action.path)
+        if self.copier:
+            self.copier.check()
+        if action.op == "MOVE":
+            self.log(action.op, action.oldpath, "->", action.path)
+        elif action.op not in ("COPYSTAT", "STASH"):
+            self.log(action.op, action.path)
+        if action.op == "COPYSTAT":
+            if self.copier:
+                self.copier.copystat(srcpath, dstpath)
+            else:
+                self.fs.copystat(srcpath, dstpath)
+        elif action.op == "COPY":
+            if self.copier:
+                self.copier.copy(srcpath, dstpath, action.stat)
+            else:
+                self.copy_file(srcpath, dstpath, action.stat)
+        elif action.op == "STASH":
+            stashpath = ".syncdirs-move-{0}-{1}".format(os.getpid(), len(self.stashed))
+            self.fs.rename(dstpath, os.path.join(self.dstroot, stashpath))
+            self.stashed[action.path] = stashpath
+        elif action.op == "MOVE":
+            oldpath = self.stashed.pop(action.oldpath, action.oldpath)
+            self.fs.rename(os.path.join(self.dstroot, oldpath), dstpath)
+            self.fs.copystat(srcpath, dstpath)
+        elif action.op == "MKDIR":
+            self.fs.mkdir(dstpath)
+        elif action.op == "REMOVE":
+            self.fs.remove(dstpath)
+        elif action.op == "RMDIR":
+            self.fs.rmdir(dstpath)
+        elif action.op == "SKIPDIR":
+            self.skipped += 1
         else:
-            self.log("MKDIR", dir)
-            self.fs.mkdir(dstdir)
-        self.fs.copystat(srcdir, dstdir)
-        for filename in filenames:
-            srcfile = os.path.join(srcdir, filename)
-            dstfile = os.path.join(dstdir, filename)
-            if os.path.isfile(srcfile):
-                will_copy = not os.path.exists(dstfile)
-                if not will_copy:
-                    srcstat = os.stat(srcfile)
-                    dststat = os.stat(dstfile)
-                    will_copy = stat_changed(srcstat, dststat)
-                if will_copy:
-                    self.log("COPY", os.path.join(dir, filename))
-                    self.fs.copy(srcfile, dstfile)
+            raise ValueError("Unknown action: " + action.op)
+        if self.index and not self.fs.dryrun:
+            self.index.apply(action)
+
+    def copy_file(self, srcpath, dstpath, stat=None):
+        self.fs.copy(srcpath, dstpath)
+        if self.verify and not self.fs.dryrun:
+            srchash = self.hashes.file_hash(srcpath, stat)
+            if self.hashes.file_hash(dstpath, uncached=True) != srchash:
+                raise EnvironmentError(errno.EIO, "Copy verification failed", dstpath)
+        if self.progress and not self.fs.dryrun:
+            self.progress.copied(stat.st_size if stat else 0)
 
     def run(self):
+        if self.logfile:
+            self.logwriter = LogWriter(self.logfile)
+        if self.progress:
+            self.progress.start()
         self.log_marker("START src={0} dst={1!r}{2}".format(
             self.srcroot, self.dstroot, " dryrun" if self.fs.dryrun else ""))
 
         try:
-            for dirpath, dirnames, filenames in self.fs.walk(self.dstroot):
-                self.visit_cleanup(dirpath, dirnames + filenames)
-
-            for dirpath, dirnames, filenames in self.fs.walk(self.srcroot):
-                self.visit_copy(dirpath, dirnames + filenames)
-        except:
+            actions = self.start_stage(self.plan(), "planner")
+            if self.detect_moves:
+                actions = self.plan_moves(list(actions))
+            for action in actions:
+                self.execute(action)
+            if self.copier:
+                self.copier.wait()
+        except BaseException as e:
+            for stage in self.stages:
+                stage.cancel()
+            if self.copier:
+                self.copier.abort(e)
+            if self.index:
+                self.index.clear()
+                self.index.commit()
+                self.index.close()
             print(traceback.format_exc())
             self.log_write(traceback.format_exc())
             self.log_marker("ABORT\n")
+            self.close("aborted")
             raise
         else:
+            if self.index:
+                self.index.commit()
+                self.index.close()
+            for name in [name for name, _ in copy_backends] + ["delta"]:
+                if name in self.fs.copy_stats:
+                    files, size, written, seconds = self.fs.copy_stats[name]
+                    self.log_marker("COPIED {0} files={1} bytes={2} written={3} saved={4} seconds={5:.2f}".format(
+                        name, files, size, written, size - written, seconds))
+            if self.skipped:
+                self.log_marker("SKIPPED dirs={0}".format(self.skipped))
             self.log_marker("FINISH\n")
+            self.close("finished")
 
-        if self.logfile:
-            with open(self.logfile, "a") as f:
-                f.write("".join(self.loglines))
-                self.loglines = []
+    def close(self, state):
+        if self.progress:
+            self.progress.stop(state)
+        if self.logwriter:
+            self.logwriter.close()
+            self.logwriter = None
 
 def get_timestamp():
     return time.strftime("%Y-%m-%d %H:%M:%S")
 
-def syncdirs(srcroot, dstroot, dryrun=True, logfile=None):
-    dirsync = DirSyncer(srcroot, dstroot, dryrun=dryrun, logfile=logfile)
+def syncdirs(srcroot, dstroot, **options):
+    dirsync = DirSyncer(srcroot, dstroot, **options)
     dirsync.run()
 
-usage = "usage: %s [--commit] [--logfile=LOGFILE] SRCDIR DSTDIR" % sys.argv[0]
+usage = ("usage: %s [--commit] [--logfile=LOGFILE] [--jobs=N] [--device-jobs=N]"
+         " [--index=INDEXFILE [--skip-unchanged-dirs]] [--delta-threshold=SIZE]"
+         " [--detect-moves] [--verify] [--progress=fd:N|unix:PATH|tcp:HOST:PORT|FILE]"
+         " SRCDIR DSTDIR" % sys.argv[0])
 
 def main(args):
     try:
-        opts, args = getopt.gnu_getopt(args, "", ["commit", "logfile="])
+        opts, args = getopt.gnu_getopt(args, "", ["commit", "logfile=", "jobs=", "device-jobs=",
+                                                  "index=", "skip-unchanged-dirs", "delta-threshold=",
+                                                  "detect-moves", "verify", "progress="])
     except getopt.GetoptError as e:
         print(str(e) + "\n\n" + usage)
         sys.exit(2)
@@ -172,19 +1073,34 @@ def main(args):
         print(usage)
         sys.exit(2)
     src, dst = args
-    dryrun = True
-    logfile = None
+    options = {}
     for o, a in opts:
         if o == "--commit":
-            dryrun = False
+            options["dryrun"] = False
         elif o == "--logfile":
-            logfile = a
+            options["logfile"] = a
+        elif o == "--index":
+            options["indexfile"] = a
+        elif o == "--progress":
+            options["progress"] = a
+        elif o in ("--skip-unchanged-dirs", "--detect-moves", "--verify"):
+            options[o[2:].replace("-", "_")] = True
+        elif o in ("--jobs", "--device-jobs", "--delta-threshold"):
+            try:
+                n = parse_size(a) if o == "--delta-threshold" else int(a)
+                if n < 1:
+                    raise ValueError
+            except ValueError:
+                print("Invalid value for {0}: {1}".format(o, a))
+                print(usage)
+                sys.exit(2)
+            options[o[2:].replace("-", "_")] = n
         else:
             print("Unknown option:", o)
             print(usage)
             sys.exit(2)
     try:
-        syncdirs(src, dst, dryrun=dryrun, logfile=logfile)
+        syncdirs(src, dst, **options)
     except SystemExit:
         raise
     except:
@@ -5,53 +5,99 @@
 # encode flac, wav as opus
 
 import argparse
+import functools
+import hashlib
+import json
 import os
 import re
 import shutil
+import sqlite3
 import subprocess
 import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
 from typing import Callable
 
-def encode_ffmpeg(input_file, output_file, codec, extra_args=[]):
-    cmd = [
-        "ffmpeg", "-hide_banner", "-y",
-        "-i", input_file,
+import encodepool
+
+def ffmpeg_output_args(codec, extra_args=[]):
+    return [
         "-map", "0:a",          # map all audio streams
         "-map", "0:v?",         # map video stream if exists
         "-map_metadata", "0",   # copy metadata
         "-c:a", codec,          # set audio codec
         "-c:v", "copy",         # copy video stream as-is
-    ] + extra_args + [
+    ] + extra_args
+
+def ffmpeg_command(input_file, outputs):
+    """Return an ffmpeg command line encoding input_file to several outputs,
+    given as (output_file, output_args) pairs, with one decode."""
+    cmd = ["ffmpeg", "-hide_banner", "-nostdin", "-y", "-i", input_file]
+    for output_file, output_args in outputs:
+        cmd += output_args + [output_file]
+    return cmd
+
+def encode_ffmpeg_outputs(input_file, outputs):
+    return subprocess.call(ffmpeg_command(input_file, outputs))
+
+def encode_ffmpeg(input_file, output_file, codec, extra_args=[]):
+    return encode_ffmpeg_outputs(input_file, [(output_file, ffmpeg_output_args(codec, extra_args))])
+
+def retag_ffmpeg(encoded_file, tagged_file, output_file):
+    """Remux encoded_file with the metadata and cover art of tagged_file,
+    without re-encoding the audio."""
+    cmd = [
+        "ffmpeg", "-hide_banner", "-nostdin", "-v", "error", "-y",
+        "-i", encoded_file,
+        "-i", tagged_file,
+        "-map", "0:a",          # audio from the encoded file
+        "-map", "1:v?",         # cover art from the source
+        "-map_metadata", "1",   # metadata from the source
+        "-c", "copy",
         output_file
     ]
     return subprocess.call(cmd)
 
-def encode_ogg(input_file, output_file, bitrate=None):
+def ogg_args(bitrate=None):
     extra_args = ["-qscale:a", "4"] if bitrate is None else ["-b:a", bitrate]
-    return encode_ffmpeg(input_file, output_file, codec="libvorbis", extra_args=extra_args)
+    return ffmpeg_output_args(codec="libvorbis", extra_args=extra_args)
 
-def encode_opus(input_file, output_file, bitrate=None):
+def opus_args(bitrate=None):
     extra_args = [] if bitrate is None else ["-b:a", bitrate]
-    return encode_ffmpeg(input_file, output_file, codec="libopus", extra_args=extra_args)
+    return ffmpeg_output_args(codec="libopus", extra_args=extra_args)
 
-def encode_aac(input_file, output_file, bitrate=None):
+def aac_args(bitrate=None):
     extra_args = ["-vbr", "4"] if bitrate is None else ["-b:a", bitrate]
-    return encode_ffmpeg(input_file, output_file, codec="libfdk_aac", extra_args=extra_args)
+    return ffmpeg_output_args(codec="libfdk_aac", extra_args=extra_args)
+
+def encode_ogg(input_file, output_file, bitrate=None):
+    return encode_ffmpeg_outputs(input_file, [(output_file, ogg_args(bitrate))])
+
+def encode_opus(input_file, output_file, bitrate=None):
+    return encode_ffmpeg_outputs(input_file, [(output_file, opus_args(bitrate))])
+
+def encode_aac(input_file, output_file, bitrate=None):
+    return encode_ffmpeg_outputs(input_file, [(output_file, aac_args(bitrate))])
 
 @dataclass
 class Encoder:
     extension: str
     encode: Callable[[str, str], int]
+    output_args: Callable[[str], list]
 
 encoders = {
-    "opus": Encoder(extension="opus", encode=encode_opus),
-    "ogg": Encoder(extension="ogg", encode=encode_ogg),
-    "aac": Encoder(extension="aac", encode=encode_aac),
+    "opus": Encoder(extension="opus", encode=encode_opus, output_args=opus_args),
+    "ogg": Encoder(extension="ogg", encode=encode_ogg, output_args=ogg_args),
+    "aac": Encoder(extension="aac", encode=encode_aac, output_args=aac_args),
 }
 
+def stat_newer(src_st, dst_st):
+    return (src_st.st_mtime - dst_st.st_mtime) > 1.0
+
 def file_newer(src, dst):
-    return (os.stat(src).st_mtime - os.stat(dst).st_mtime) > 1.0
+    return stat_newer(os.stat(src), os.stat(dst))
 
 def split_ext(filename):
     basename, ext = os.path.splitext(filename)
@@ -63,22 +109,373 @@ def remove(path):
     except Exception:
         pass
 
-def find_files(path):
-    for dirpath, dirnames, filenames in os.walk(path):
-        dirnames[:] = [d for d in dirnames if not d.startswith('.')]
-        dirnames.sort()
-        filenames.sort()
-        for filename in filenames:
-            if not filename.startswith('.'):
-                filepath = os.path.join(dirpath, filename)
-                relpath = os.path.relpath(filepath, path)
-                yield relpath
-
-def find_files_by_extension(path, extensions):
-    for filename in find_files(path):
-        ext = split_ext(filename)[1]
-        if ext in extensions:
-            yield filename
+def temp_path(dstfile):
+    # Keep the extension so ffmpeg can tell the output format
+    dirname, filename = os.path.split(dstfile)
+    return os.path.join(dirname, ".syncmusic-" + filename)
+
+def encode_file(encoder, srcfile, dstfile, bitrate=None):
+    return encode_file_outputs(srcfile, [(encoder, dstfile, bitrate)])
+
+def encode_file_outputs(srcfile, outputs, run=encodepool.encode):
+    """Encode srcfile to several outputs, given as (encoder, dstfile,
+    bitrate) tuples, with a single decode. The job is passed to run, which
+    returns its encodepool.EncodeResult once the outputs are moved into
+    place. By default it runs on the calling thread."""
+    tmpfiles = [temp_path(dstfile) for encoder, dstfile, bitrate in outputs]
+    command = ffmpeg_command(srcfile, [(tmpfile, encoder.output_args(bitrate))
+                                       for tmpfile, (encoder, dstfile, bitrate) in zip(tmpfiles, outputs)])
+    job = encodepool.EncodeJob(command, [(tmpfile, dstfile) for tmpfile, (encoder, dstfile, bitrate) in zip(tmpfiles, outputs)])
+    try:
+        result = run(job)
+    except:
+        for encoder, dstfile, bitrate in outputs:
+            remove(dstfile)
+        raise
+    if result.returncode != 0:
+        print("Error: encoder return error code {0} for file: {1}".format(result.returncode, srcfile))
+        for encoder, dstfile, bitrate in outputs:
+            remove(dstfile)
+        return False
+    print("Encoded: {0} ({1})".format(srcfile, result.timings()))
+    return True
+
+def copy_file(srcfile, dstfile):
+    print("Copying:", srcfile)
+    tmpfile = temp_path(dstfile)
+    try:
+        shutil.copy2(srcfile, tmpfile)
+        os.replace(tmpfile, dstfile)
+    except Exception as e:
+        print("Error: Failed to copy file: {0}".format(e))
+        remove(tmpfile)
+        remove(dstfile)
+    except:
+        remove(tmpfile)
+        remove(dstfile)
+        raise
+
+def link_or_copy(src, dst):
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+
+def hash_file(path):
+    h = hashlib.blake2b()
+    with open(path, "rb") as f:
+        for block in iter(functools.partial(f.read, 1024 * 1024), b""):
+            h.update(block)
+    return h.hexdigest()
+
+@functools.lru_cache(maxsize=None)
+def ffmpeg_version():
+    try:
+        output = subprocess.check_output(["ffmpeg", "-version"], stderr=subprocess.DEVNULL)
+        return output.decode("utf-8", "replace").split("\n", 1)[0].strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+def flac_fingerprint(f):
+    """Return hashes of the audio and of the tags of an open FLAC file,
+    positioned after the fLaC marker. The audio hash is taken from the
+    STREAMINFO block, which holds an MD5 of the decoded samples, so
+    retagging a file doesn't change it."""
+    audio = None
+    tags = hashlib.blake2b()
+    while True:
+        header = f.read(4)
+        if len(header) < 4:
+            break
+        block_type = header[0] & 0x7f
+        data = f.read(int.from_bytes(header[1:], "big"))
+        if block_type == 0 and data[18:34] != bytes(16):
+            audio = hashlib.blake2b(data).hexdigest()
+        elif block_type in (4, 6):  # VORBIS_COMMENT, PICTURE
+            tags.update(header + data)
+        if header[0] & 0x80:
+            break
+    if audio is None:
+        # No MD5 in STREAMINFO, hash the audio frames instead
+        h = hashlib.blake2b()
+        for block in iter(functools.partial(f.read, 1024 * 1024), b""):
+            h.update(block)
+        audio = h.hexdigest()
+    return audio, tags.hexdigest()
+
+def fingerprint_file(path):
+    """Return (audio, tags) hashes of a source file. Other than for FLAC
+    both are the hash of the whole file."""
+    with open(path, "rb") as f:
+        if f.read(4) == b"fLaC":
+            return flac_fingerprint(f)
+    h = hash_file(path)
+    return h, h
+
+def transcode_key(audio_hash, encoder, bitrate):
+    settings = [audio_hash, encoder.extension, encoder.encode.__name__, bitrate or "", ffmpeg_version()]
+    return hashlib.blake2b("\0".join(settings).encode("utf-8"), digest_size=20).hexdigest()
+
+manifest_name = ".syncmusic-manifest.json"
+
+class Manifest:
+    """Records, for each encoded file in a destination directory, the size,
+    mtime, audio and tags hashes of its source and the transcode key it was
+    encoded with. Stored as JSON in the destination directory."""
+
+    def __init__(self, dstpath):
+        self.path = os.path.join(dstpath, manifest_name)
+        self.lock = threading.Lock()
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                self.outputs = json.load(f)["outputs"]
+        except (OSError, ValueError, KeyError):
+            self.outputs = {}
+
+    def get(self, dstname):
+        with self.lock:
+            return self.outputs.get(dstname)
+
+    def record(self, dstname, srcname, st, audio, tags, key):
+        with self.lock:
+            self.outputs[dstname] = {
+                "source": srcname,
+                "size": st.st_size,
+                "mtime": st.st_mtime,
+                "audio": audio,
+                "tags": tags,
+                "key": key,
+            }
+
+    def discard(self, dstname):
+        with self.lock:
+            self.outputs.pop(dstname, None)
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmpfile = temp_path(self.path)
+        with self.lock:
+            with open(tmpfile, "w", encoding="utf-8") as f:
+                json.dump({"outputs": self.outputs}, f, indent=0, sort_keys=True)
+        os.replace(tmpfile, self.path)
+
+class TranscodeCache:
+    """Content-addressed store of encoded files, shared between
+    destinations. Files are stored by transcode key and the least recently
+    used are evicted once the cache is over max_size bytes. Files are
+    hardlinked in and out of the cache where possible."""
+
+    def __init__(self, path, max_size):
+        self.path = path
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        os.makedirs(path, exist_ok=True)
+        self.db = sqlite3.connect(os.path.join(path, "cache.db"), check_same_thread=False)
+        self.db.execute("CREATE TABLE IF NOT EXISTS objects (name TEXT PRIMARY KEY, size INTEGER, last_used REAL)")
+        self.db.commit()
+
+    def object_path(self, name):
+        return os.path.join(self.path, name[:2], name)
+
+    def fetch(self, key, extension, dstfile):
+        name = key + os.path.extsep + extension
+        path = self.object_path(name)
+        with self.lock:
+            if self.db.execute("SELECT 1 FROM objects WHERE name = ?", (name,)).fetchone() is None:
+                return False
+            self.db.execute("UPDATE objects SET last_used = ? WHERE name = ?", (time.time(), name))
+            self.db.commit()
+        try:
+            remove(dstfile)
+            link_or_copy(path, dstfile)
+        except OSError:
+            return False
+        return True
+
+    def store(self, key, extension, srcfile):
+        name = key + os.path.extsep + extension
+        path = self.object_path(name)
+        tmpfile = temp_path(path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        remove(tmpfile)
+        link_or_copy(srcfile, tmpfile)
+        os.replace(tmpfile, path)
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO objects VALUES (?, ?, ?)",
+                            (name, os.stat(path).st_size, time.time()))
+            self.evict()
+            self.db.commit()
+
+    def evict(self):
+        total = self.db.execute("SELECT COALESCE(SUM(size), 0) FROM objects").fetchone()[0]
+        while total > self.max_size:
+            oldest = self.db.execute("SELECT name, size FROM objects ORDER BY last_used LIMIT 100").fetchall()
+            if not oldest:
+                break
+            for name, size in oldest:
+                remove(self.object_path(name))
+                self.db.execute("DELETE FROM objects WHERE name = ?", (name,))
+                total -= size
+                if total <= self.max_size:
+                    break
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+class Transcoder:
+    """Brings encoded outputs up to date.
+
+    An output is current if it was encoded from the same source audio
+    with the same encoder, bitrate and ffmpeg version, as recorded in the
+    manifest. If only the source tags changed it is remuxed with the new
+    tags. Otherwise it is taken from the transcode cache if possible, and
+    encoded if not."""
+
+    def __init__(self, encoder, bitrate, manifest, cache=None):
+        self.encoder = encoder
+        self.bitrate = bitrate
+        self.manifest = manifest
+        self.cache = cache
+
+    def stale_reason(self, dstname, st):
+        """Return why an existing output needs checking, without reading
+        its source, or None if it is current."""
+        entry = self.manifest.get(dstname)
+        if entry is None:
+            return "untracked"
+        if entry["size"] != st.st_size or entry["mtime"] != st.st_mtime:
+            return "source changed"
+        if entry["key"] != transcode_key(entry.get("audio"), self.encoder, self.bitrate):
+            return "settings changed"
+        return None
+
+    def fingerprint(self, srcfile, st, entry):
+        if entry and entry["size"] == st.st_size and entry["mtime"] == st.st_mtime and "audio" in entry:
+            return entry["audio"], entry["tags"]
+        return fingerprint_file(srcfile)
+
+    def retag(self, srcfile, dstfile):
+        tmpfile = temp_path(dstfile)
+        try:
+            rc = retag_ffmpeg(dstfile, srcfile, tmpfile)
+            if rc != 0:
+                print("Error: retag returned error code {0} for file: {1}".format(rc, srcfile))
+                remove(tmpfile)
+                return False
+            os.replace(tmpfile, dstfile)
+            return True
+        except:
+            remove(tmpfile)
+            raise
+
+    def prepare(self, srcfile, dstfile, srcname, dstname, st, adopt=False):
+        """Update dstfile from srcfile if that can be done without
+        encoding, otherwise return a PendingEncode to pass to finish once
+        it is encoded. With adopt, an existing output that isn't in the
+        manifest is assumed to be encoded with the current settings and is
+        just recorded."""
+        entry = self.manifest.get(dstname)
+        audio, tags = self.fingerprint(srcfile, st, entry)
+        key = transcode_key(audio, self.encoder, self.bitrate)
+        if adopt or (entry and entry["key"] == key and os.path.exists(dstfile)):
+            if adopt or entry.get("tags") == tags:
+                self.manifest.record(dstname, srcname, st, audio, tags, key)
+                return None
+            print("Retagging:", srcfile)
+            if self.retag(srcfile, dstfile):
+                self.manifest.record(dstname, srcname, st, audio, tags, key)
+                return None
+        if self.cache:
+            tmpfile = temp_path(dstfile)
+            if self.cache.fetch(key, self.encoder.extension, tmpfile):
+                # The cached file may carry tags from another copy of the source
+                print("Cached:", srcfile)
+                os.replace(tmpfile, dstfile)
+                if audio == tags or self.retag(srcfile, dstfile):
+                    self.manifest.record(dstname, srcname, st, audio, tags, key)
+                    return None
+        return PendingEncode(self, srcfile, dstfile, srcname, dstname, st, audio, tags, key)
+
+    def finish(self, pending, success):
+        if success:
+            self.manifest.record(pending.dstname, pending.srcname, pending.st, pending.audio, pending.tags, pending.key)
+            if self.cache:
+                self.cache.store(pending.key, self.encoder.extension, pending.dstfile)
+        else:
+            self.manifest.discard(pending.dstname)
+
+    def transcode(self, *args, **kwargs):
+        transcode_targets([(self, args, kwargs)])
+
+@dataclass
+class PendingEncode:
+    transcoder: Transcoder
+    srcfile: str
+    dstfile: str
+    srcname: str
+    dstname: str
+    st: os.stat_result
+    audio: str
+    tags: str
+    key: str
+
+def transcode_targets(transcodes, run=encodepool.encode):
+    """Bring the outputs of one source file up to date for several targets,
+    given as (transcoder, args, kwargs) for Transcoder.prepare. Outputs that
+    need encoding are all encoded by one ffmpeg process, run by run as for
+    encode_file_outputs."""
+    pending = [p for p in (transcoder.prepare(*args, **kwargs) for transcoder, args, kwargs in transcodes)
+               if p is not None]
+    if pending:
+        success = encode_file_outputs(pending[0].srcfile, [(p.transcoder.encoder, p.dstfile, p.transcoder.bitrate)
+                                                           for p in pending], run)
+        for p in pending:
+            p.transcoder.finish(p, success)
+
+def scan_tree(path, extensions=None):
+    """Scan a tree in one os.scandir pass. Returns a dict of the relative
+    paths of its files to their stat results, optionally only files with
+    the given extensions, and the set of its directories, with "" for the
+    root if it exists. Hidden files and directories are skipped, and
+    symlinks to directories aren't followed."""
+    files = {}
+    dirs = set()
+    stack = [""]
+    while stack:
+        reldir = stack.pop()
+        try:
+            it = os.scandir(os.path.join(path, reldir))
+        except OSError:
+            continue
+        dirs.add(reldir)
+        with it:
+            for entry in it:
+                if entry.name.startswith('.'):
+                    continue
+                relpath = os.path.join(reldir, entry.name)
+                try:
+                    if entry.is_dir():
+                        if not entry.is_symlink():
+                            stack.append(relpath)
+                    elif extensions is None or split_ext(entry.name)[1] in extensions:
+                        files[relpath] = entry.stat()
+                except OSError:
+                    pass
+    return files, dirs
+
+def make_parent_dirs(root, relpath, dirs):
+    """Create the parent directories of relpath under root unless they are
+    in dirs, the set of directories known to exist, and add them to it."""
+    dirname = os.path.dirname(relpath)
+    if dirname in dirs:
+        return
+    os.makedirs(os.path.join(root, dirname), exist_ok=True)
+    while dirname not in dirs:
+        dirs.add(dirname)
+        if not dirname:
+            break
+        dirname = os.path.dirname(dirname)
 
 def find_preferred_files(filenames, extensions):
     ext_priority = {ext: i for i, ext in enumerate(extensions)}
@@ -90,6 +487,9 @@ def find_preferred_files(filenames, extensions):
             preferred[basename] = filename
     return sorted(preferred.values())
 
+def output_name(filename, encoder):
+    return replace_invalid_chars(replace_extension(filename, lossless_extensions, encoder.extension))
+
 def replace_extension(filename, exts_from, ext_to):
     name, ext = split_ext(filename)
     return name + os.path.extsep + ext_to if ext in exts_from else filename
@@ -102,40 +502,151 @@ def replace_invalid_chars(filename):
 default_dst_extensions = ("flac", "wav", "m4a", "aac", "opus", "ogg", "mp3")
 lossless_extensions = ("flac", "wav")
 
-def sync_music(srcpath, dstpath, encoder, bitrate=None, dst_extensions=default_dst_extensions):
-    srcfiles = list(find_files_by_extension(srcpath, dst_extensions))
-    srcfiles = find_preferred_files(srcfiles, dst_extensions)
-    dstfiles = frozenset(find_files(dstpath))
-
-    files_to_delete = sorted(dstfiles - frozenset(replace_invalid_chars(replace_extension(x, lossless_extensions, encoder.extension)) for x in srcfiles))
-    for filename in files_to_delete:
-        filename = os.path.join(dstpath, filename)
-        print("Removing:", filename)
-        remove(filename)
-
-    for filename in srcfiles:
-        srcfile = os.path.join(srcpath, filename)
-        dstfile = os.path.join(dstpath, replace_invalid_chars(filename))
-        os.makedirs(os.path.dirname(dstfile), exist_ok=True)
+# Number of threads for plain copies when running encodes in parallel
+copy_jobs = 4
+
+default_cache_size = 20 * 1024 ** 3
+
+def parse_size(s):
+    s = s.strip().upper()
+    for i, suffix in enumerate("KMGT"):
+        if s.endswith(suffix):
+            return int(float(s[:-1]) * 1024 ** (i + 1))
+    return int(s)
+
+class JobRunner:
+    """Runs transcodes and copies on separate thread pools, or inline if
+    jobs is 1. A transcode is prepared on its own thread, which fingerprints
+    the source and checks the cache, and the encode itself goes to a shared
+    encodepool.EncodePool sized to the number of cores, which keeps the
+    time spent in each stage."""
+
+    def __init__(self, jobs=1):
+        self.encode_pool = encodepool.EncodePool(jobs)
+        self.prepare_pool = ThreadPoolExecutor(jobs) if jobs > 1 else None
+        self.copy_pool = ThreadPoolExecutor(copy_jobs) if jobs > 1 else None
+        self.futures = []
+
+    def submit(self, pool, func, *args, **kwargs):
+        if pool is None:
+            func(*args, **kwargs)
+        else:
+            self.futures.append(pool.submit(func, *args, **kwargs))
+
+    def run_encode(self, job):
+        if self.prepare_pool is None:
+            return self.encode_pool.run(job)
+        return self.encode_pool.submit(job).result()
+
+    def transcode(self, transcodes):
+        self.submit(self.prepare_pool, transcode_targets, transcodes, self.run_encode)
+
+    def copy(self, *args, **kwargs):
+        self.submit(self.copy_pool, copy_file, *args, **kwargs)
+
+    def wait(self):
         try:
-            if split_ext(filename)[1] in lossless_extensions:
-                dstfile = os.path.splitext(dstfile)[0] + os.path.extsep + encoder.extension
-                if not os.path.exists(dstfile) or file_newer(srcfile, dstfile):
-                    rc = encoder.encode(srcfile, dstfile, bitrate=bitrate)
-                    if rc != 0:
-                        print("Error: encoder return error code {0} for file: {1}".format(rc, srcfile))
-                        remove(dstfile)
+            for future in self.futures:
+                future.result()
+        finally:
+            self.shutdown()
+
+    def summary(self):
+        if self.encode_pool.totals["jobs"]:
+            print(self.encode_pool.summary())
+
+    def shutdown(self):
+        # The prepare threads wait on the encode pool, so it goes last
+        for pool in (self.prepare_pool, self.copy_pool, self.encode_pool):
+            if pool is not None:
+                pool.shutdown(wait=True, cancel_futures=True)
+
+def plan_sync(srcpath, dstpath, encoder, dst_extensions=default_dst_extensions, srcfiles=None):
+    """Scan the source and destination trees. Returns a dict mapping each
+    destination name to its source name, source stat and whether it is
+    encoded, in source order, and the files and directories of the
+    destination as returned by scan_tree. Pass srcfiles from scan_tree to
+    plan several destinations from one scan of the source."""
+    if srcfiles is None:
+        srcfiles = scan_tree(srcpath, dst_extensions)[0]
+    dstfiles, dstdirs = scan_tree(dstpath)
+    outputs = {}
+    for filename in find_preferred_files(srcfiles, dst_extensions):
+        lossless = split_ext(filename)[1] in lossless_extensions
+        outputs[output_name(filename, encoder)] = (filename, srcfiles[filename], lossless)
+    return outputs, dstfiles, dstdirs
+
+def sync_music(srcpath, dstpath, encoder, bitrate=None, dst_extensions=default_dst_extensions, jobs=1,
+               cache_path=None, cache_size=default_cache_size):
+    sync_music_targets(srcpath, [(dstpath, encoder, bitrate)], dst_extensions=dst_extensions, jobs=jobs,
+                       cache_path=cache_path, cache_size=cache_size)
+
+def sync_music_targets(srcpath, targets, dst_extensions=default_dst_extensions, jobs=1,
+                       cache_path=None, cache_size=default_cache_size):
+    """Sync srcpath to several targets, given as (dstpath, encoder, bitrate)
+    tuples. Each target is planned as by sync_music, but a source file that
+    needs encoding for more than one target is decoded only once."""
+    srcfiles = scan_tree(srcpath, dst_extensions)[0]
+    cache = TranscodeCache(cache_path, cache_size) if cache_path else None
+    manifests = []
+    transcodes = {}
+    runner = JobRunner(jobs)
+    try:
+        for dstpath, encoder, bitrate in targets:
+            outputs, dstfiles, dstdirs = plan_sync(srcpath, dstpath, encoder, dst_extensions, srcfiles)
+            manifest = Manifest(dstpath)
+            manifests.append(manifest)
+
+            files_to_delete = sorted(dstfiles.keys() - outputs.keys())
+            for filename in files_to_delete:
+                manifest.discard(filename)
+                filename = os.path.join(dstpath, filename)
+                print("Removing:", filename)
+                remove(filename)
+
+            transcoder = Transcoder(encoder, bitrate, manifest, cache)
+            for dstname, (filename, st, lossless) in outputs.items():
+                dst_st = dstfiles.get(dstname)
+                if dst_st is not None and not lossless and not stat_newer(st, dst_st):
+                    continue
+                if dst_st is not None and lossless and not transcoder.stale_reason(dstname, st):
+                    continue
+                srcfile = os.path.join(srcpath, filename)
+                dstfile = os.path.join(dstpath, dstname)
+                if dst_st is None:
+                    make_parent_dirs(dstpath, dstname, dstdirs)
+                if lossless:
+                    adopt = dst_st is not None and manifest.get(dstname) is None and not stat_newer(st, dst_st)
+                    args = (srcfile, dstfile, filename, dstname, st)
+                    transcodes.setdefault(filename, []).append((transcoder, args, dict(adopt=adopt)))
+                else:
+                    runner.copy(srcfile, dstfile)
+
+        for filename in sorted(transcodes):
+            runner.transcode(transcodes[filename])
+        runner.wait()
+        runner.summary()
+    except:
+        runner.shutdown()
+        raise
+    finally:
+        for manifest in manifests:
+            manifest.save()
+        if cache:
+            cache.close()
+
+def print_stale(srcpath, dstpath, encoder, bitrate=None, dst_extensions=default_dst_extensions):
+    """List the encoded outputs that a sync would check or re-encode."""
+    outputs, dstfiles, dstdirs = plan_sync(srcpath, dstpath, encoder, dst_extensions)
+    transcoder = Transcoder(encoder, bitrate, Manifest(dstpath))
+    for dstname, (filename, st, lossless) in outputs.items():
+        if lossless:
+            if dstname not in dstfiles:
+                reason = "missing"
             else:
-                if not os.path.exists(dstfile) or file_newer(srcfile, dstfile):
-                    print("Copying:", srcfile)
-                    try:
-                        shutil.copy2(srcfile, dstfile)
-                    except Exception as e:
-                        print("Error: Failed to copy file: {0}".format(e))
-                        remove(dstfile)
-        except:
-            remove(dstfile)
-            raise
+                reason = transcoder.stale_reason(dstname, st)
+            if reason:
+                print("{0}: {1}".format(reason, dstname))
 
 def sync_music_opus(srcpath, dstpath, bitrate=None):
     sync_music(srcpath, dstpath, encoder=encoders["opus"], bitrate=bitrate)
@@ -150,22 +661,51 @@ def main():
     valid_formats = sorted(encoders.keys())
     argparser = argparse.ArgumentParser(description="Sync audio files from source to destination directory.")
     argparser.add_argument("srcpath", help="Source directory containing music files.")
-    argparser.add_argument("dstpath", help="Destination directory to sync music files to.")
+    argparser.add_argument("dstpath", nargs="?", help="Destination directory to sync music files to.")
     argparser.add_argument("--format", choices=valid_formats, default="opus",
                         help="Format to encode audio files into (default: opus).")
     argparser.add_argument("--bitrate", default=None,
                         help=f"Bitrate for encoding. If not specified, use default VBR settings for the format.")
+    argparser.add_argument("--target", action="append", default=[], metavar="FORMAT[,BITRATE]:DSTPATH",
+                        help="Also sync to DSTPATH in FORMAT. May be given several times; each source file is "
+                             "decoded once for all targets.")
+    argparser.add_argument("--jobs", type=int, default=1,
+                        help="Number of files to encode in parallel, 0 for the number of cores (default: 1).")
+    argparser.add_argument("--cache", default=None,
+                        help="Directory of a transcode cache to share encoded files between destinations.")
+    argparser.add_argument("--cache-size", type=parse_size, default=default_cache_size,
+                        help="Maximum size of the transcode cache, e.g. 50G (default: 20G).")
+    argparser.add_argument("--stale", action="store_true",
+                        help="List encoded files that are out of date instead of syncing.")
     args = argparser.parse_args()
     if args.format not in encoders:
         print("Error: Invalid format specified. Choose from: {}".format(", ".join(valid_formats)))
         sys.exit(1)
-    sync_music(args.srcpath, args.dstpath, encoder=encoders[args.format], bitrate=args.bitrate)
+    targets = []
+    if args.dstpath:
+        targets.append((args.dstpath, encoders[args.format], args.bitrate))
+    for target in args.target:
+        spec, _, dstpath = target.partition(":")
+        fmt, _, bitrate = spec.partition(",")
+        if fmt not in encoders or not dstpath:
+            print("Error: Invalid target: {0}".format(target))
+            sys.exit(1)
+        targets.append((dstpath, encoders[fmt], bitrate or None))
+    if not targets:
+        argparser.error("a destination directory or --target is required")
+    if args.stale:
+        for dstpath, encoder, bitrate in targets:
+            print_stale(args.srcpath, dstpath, encoder=encoder, bitrate=bitrate)
+        return
+    jobs = args.jobs or os.cpu_count()
+    sync_music_targets(args.srcpath, targets, jobs=jobs, cache_path=args.cache, cache_size=args.cache_size)
 
 if __name__ == "__main__":
     main()
 
 __all__ = [
-    "sync_music"
+    "sync_music",
+    "sync_music_targets",
     "sync_music_opus",
     "sync_music_vorbis",
     "sync_music_aac",